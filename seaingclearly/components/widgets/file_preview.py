@@ -100,7 +100,9 @@ class EnhancedImageLoaderWorker(QObject):
         _, img_encoded = cv2.imencode('.jpg', image) 
         image_bytes = img_encoded.tobytes()
         
-        api_service.enhanceImage(image_bytes)
+        # Arrowing through the file list supersedes the previous image's job, and
+        # the preview shows it while the full resolution result is processed
+        api_service.streamImage(image_bytes, progressive=True, supersede=True)
 
     def onEnhancedImage(self, enhanced_image_bytes: bytes):
         byte_array = QByteArray(enhanced_image_bytes)
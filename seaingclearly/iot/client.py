@@ -10,6 +10,11 @@ import requests
 class ReAuthException(Exception):
     pass
 
+class RetryLaterException(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Server busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
 load_dotenv()
 
 API_HOST = os.environ.get("API_HOST")
@@ -63,24 +68,35 @@ class SeaingAPIClient:
         return response_json
 
 
-    def upload(self, img_bytes, session_id):
+    def upload(self, img_bytes, session_id, progressive=False, encoding=None, supersede=False):
         files = { "file": ("image.jpg", img_bytes, "image/jpeg") }
         data = {
-            "session_id": session_id  # Add session_id to the form data
+            "session_id": session_id,  # Add session_id to the form data
+            "progressive": "true" if progressive else "false",
+            "supersede": "true" if supersede else "false",
         }
 
+        # Output encoder settings for this job only, e.g. {"output_quality": 70}
+        for name, value in (encoding or {}).items():
+            data[name] = str(value).lower() if isinstance(value, bool) else value
+
         response = self.session.post(
             self._constructUrl(SeaingAPIClient.Endpoints.ENHANCE),
             files=files,
             data=data
         )
 
-        if response.status_code == 200:
+        if 200 <= response.status_code < 300:
             self.logger.info(f"{SeaingAPIClient.Endpoints.ENHANCE.value} - {response.status_code}")
         elif response.status_code == 401:
             raise ReAuthException("Unauthenticated")
+        elif response.status_code == 429:
+            self.logger.warning(f"{SeaingAPIClient.Endpoints.ENHANCE.value} - {response.status_code}")
+            raise RetryLaterException(float(response.headers.get("Retry-After", 1)))
         else:
             self.logger.error(f"{SeaingAPIClient.Endpoints.ENHANCE.value} - {response.status_code} - {response.json()}")
             raise Exception(f"Failed to upload to {SeaingAPIClient.Endpoints.ENHANCE.value}")
+
+        return response.json()
         
         
@@ -2,15 +2,16 @@ import hashlib
 import json
 import logging
 import os
+import threading
 import uuid
+from collections import deque
 from requests.exceptions import ConnectionError
 
 
-from seaingclearly.iot.client import SeaingAPIClient, ReAuthException
+from seaingclearly.iot.client import SeaingAPIClient, ReAuthException, RetryLaterException
 from concurrent.futures import ThreadPoolExecutor
 
 import websocket
-import base64
 
 from .util import DeviceInfo
 
@@ -35,6 +36,19 @@ class SeaingService:
         ws (WebSocketApp): WebSocket connection for receiving image enhancement updates.
         enhanced_image_callback (Callable): Callback function for handling enhanced image data.
         session_id (UUID): Unique session identifier for the service.
+        completed_job_id (str): ID of the last job whose full resolution result arrived.
+        latest_job_id (str): ID of the last job uploaded.
+        uploads (int): Count of images uploaded, so a deferred retry can tell a newer
+            upload has started since.
+        result_header (dict): Header of the result whose image frame is expected next.
+        superseded_job_ids (deque): Recent jobs superseded by a newer upload, whose
+            results are ignored.
+        config_version (int): Version of the session configuration last set, compared
+            with the version streamed images were accepted with.
+        streamed (dict): Images streamed over the WebSocket and not yet accepted,
+            kept by job ID to retry them when the server is busy or the session
+            has to be re-authenticated.
+        ws_open (threading.Event): Set while the WebSocket is connected.
     """
     
     executor = ThreadPoolExecutor(max_workers=5)
@@ -53,6 +67,16 @@ class SeaingService:
         self.ws = None 
         self.enhanced_image_callback = None
         self.session_id = uuid.uuid4()
+        self.completed_job_id = None
+        self.latest_job_id = None
+        self.uploads = 0
+        self.superseded_job_ids = deque(maxlen=64)
+        self.result_header = None
+        self.config_version = 0
+        self.streamed = {}
+        self.ws_open = threading.Event()
+        self._stream_lock = threading.Lock()
+        self._reauth_lock = threading.Lock()
 
         self.logger.info("Starting Seaing Service")
         self.logger.info("Device: %s", json.dumps(self.device_info))
@@ -62,37 +86,127 @@ class SeaingService:
         """
         Establishes a WebSocket connection to receive image enhancement updates.
 
-        The WebSocket URL includes the session ID for identifying the connection.
+        The WebSocket URL includes the session ID for identifying the connection, and
+        the handshake carries the session cookie so images can be streamed on it.
         """
 
+        # A re-authenticated session replaces the connection opened with the old cookie
+        if self.ws is not None:
+            self.ws.close()
+        self.ws_open.clear()
+
         ws_url = f"ws://localhost:5000/updates?session_id={self.session_id}"
+        cookie = "; ".join(f"{c.name}={c.value}" for c in self.client.session.cookies)
         self.ws = websocket.WebSocketApp(ws_url,
                                          on_message=self.on_message,
                                          on_error=self.on_error,
-                                         on_close=self.on_close)
+                                         on_close=self.on_close,
+                                         cookie=cookie or None)
         self.ws.on_open = self.on_open
 
         self.executor.submit(self.ws.run_forever)
 
     def on_message(self, ws, message):
         """
-        Handles incoming WebSocket messages. If the message contains an image, 
-        it decodes the image and calls the callback function if set.
+        Handles incoming WebSocket messages. Results arrive as a JSON header frame
+        followed by a binary frame holding the encoded image, which is passed to
+        the callback function if set.
 
         Args:
             ws (WebSocketApp): The WebSocket instance.
-            message (str): The incoming WebSocket message.
+            message (str | bytes): The incoming WebSocket message, bytes for
+                binary frames.
         """
 
+        if isinstance(message, bytes):
+            header, self.result_header = self.result_header, None
+            if header is None:
+                self.logger.warning("Received an image frame without a header")
+                return
+
+            self._onResult(header, message)
+            return
+
         data = json.loads(message)
 
-        if "image" in data:
-            enhanced_image_base64 = data["image"]
-            enhanced_image_bytes = base64.b64decode(enhanced_image_base64)
+        if data.get("type") == "accepted":
+            self.streamed.pop(data.get("job_id"), None)
+            if data.get("config_version", self.config_version) < self.config_version:
+                self.logger.info(f"Job {data.get('job_id')} runs with an earlier configuration")
+        elif data.get("type") == "rejected":
+            self._onRejected(ws, data)
+        elif "image_size" in data:
+            self.result_header = data
+
+    def _onRejected(self, ws, data: dict):
+        """
+        Handles an image streamed over the WebSocket being turned away. It is sent
+        again after `retry_after` when the server's job queue is full, and after
+        re-authenticating when the session is no longer authenticated.
+
+        Args:
+            ws (WebSocketApp): The WebSocket that rejected the image.
+            data (dict): The `rejected` frame, with the job ID, status and error.
+        """
+
+        job_id = data.get("job_id")
+        stream = self.streamed.get(job_id)
+
+        if data.get("status") == 429 and stream is not None and stream["retries"] > 0:
+            self.logger.info(f"Server busy, retry after {data.get('retry_after')}s, {stream['retries']} retries left")
+            stream["retries"] -= 1
+            threading.Timer(data.get("retry_after") or 1, self._resendStream, args=(job_id,)).start()
+        elif data.get("status") == 401 and stream is not None and not stream["reauthenticated"]:
+            stream["reauthenticated"] = True
+            self.executor.submit(self._reauthenticateStream, ws, job_id)
+        else:
+            self.streamed.pop(job_id, None)
+            self.logger.error(f"Streamed image rejected: {data.get('status')} - {data.get('error')}")
+
+    def _reauthenticateStream(self, ws, job_id: str):
+        """
+        Re-authenticates after a streamed image was rejected as unauthorized, then
+        sends it again. Images rejected on the same connection share one
+        re-authentication.
+        """
 
-            # Call the callback function if it's set
-            if self.enhanced_image_callback:
-                self.enhanced_image_callback(enhanced_image_bytes)
+        try:
+            with self._reauth_lock:
+                if self.ws is ws:
+                    self.logger.info("Re-authenticating")
+                    self.authenticate()
+                    if self.config is not None:
+                        self._setConfig(self.config)
+        except Exception as e:
+            self.streamed.pop(job_id, None)
+            self.logger.error(f"Dropping streamed image: {e}")
+            return
+
+        self.ws_open.wait(timeout=5)
+        self._resendStream(job_id)
+
+    def _onResult(self, header: dict, enhanced_image_bytes: bytes):
+        """
+        Passes a result's image to the callback function. Results of superseded
+        jobs, and previews arriving after the full result of their job, are ignored.
+
+        Args:
+            header (dict): The result header, with the job ID and durations.
+            enhanced_image_bytes (bytes): The encoded image.
+        """
+
+        if header.get("job_id") in self.superseded_job_ids:
+            return
+
+        if header.get("preview"):
+            if header.get("job_id") == self.completed_job_id:
+                return
+        else:
+            self.completed_job_id = header.get("job_id")
+
+        # Call the callback function if it's set
+        if self.enhanced_image_callback:
+            self.enhanced_image_callback(enhanced_image_bytes)
 
     def on_open(self, ws):
         """
@@ -102,6 +216,8 @@ class SeaingService:
             ws (WebSocketApp): The WebSocket instance.
         """
 
+        if ws is self.ws:
+            self.ws_open.set()
         self.logger.info("WebSocket connection opened")
 
     def on_error(self, ws, error):
@@ -125,6 +241,8 @@ class SeaingService:
             close_msg (str): The close message.
         """
 
+        if ws is self.ws:
+            self.ws_open.clear()
         self.logger.info("WebSocket connection closed")
 
     def authenticate(self):
@@ -154,28 +272,166 @@ class SeaingService:
         
         self._connect_to_websocket()
 
-    def enhanceImage(self, img_bytes):
+    def enhanceImage(self, img_bytes, progressive=False, encoding=None, retries=3, supersede=False):
         """
         Uploads an image for enhancement to the SeaingServer.
 
         Args:
             img_bytes (bytes): The image data to be enhanced.
+            progressive (bool): Request a fast preview ahead of the full resolution
+                result. Both are passed to `enhanced_image_callback`.
+            encoding (dict): Output encoder settings for this job, overriding the
+                session configuration (e.g. `{"output_format": "image/webp"}`).
+            retries (int): Times the upload is retried after the server's
+                `Retry-After` when its job queue is full.
+            supersede (bool): Latest wins, cancel the unfinished jobs of this session
+                and ignore their results.
+
+        Returns:
+            str: The job ID, or None if the upload failed or was deferred.
 
         Raises:
             ReAuthException: If re-authentication is required.
             Exception: If other errors occur during image enhancement.
         """
 
+        self.uploads += 1
+        upload = self.uploads
+
         try: 
-            self.client.upload(img_bytes, self.session_id)
+            if supersede and self.latest_job_id is not None:
+                self.superseded_job_ids.append(self.latest_job_id)
+
+            response = self.client.upload(img_bytes, self.session_id, progressive, encoding, supersede)
         except ReAuthException:
             self.logger.info("Re-authenticating")
             self.authenticate()
             self.setConfig(self.config)
-            return self.enhanceImage(img_bytes)
+            return self.enhanceImage(img_bytes, progressive, encoding, retries, supersede)
+
+        except RetryLaterException as e:
+            if retries > 0:
+                self.logger.info(f"{e}, {retries} retries left")
+                threading.Timer(
+                    e.retry_after, self._retryUpload, args=(upload, img_bytes, progressive, encoding, retries - 1, supersede)
+                ).start()
+            else:
+                self.logger.error(f"Server busy, dropping image: {e}")
+            return None
 
         except Exception as e:
             self.logger.exception(e)
+            return None
+
+        self.latest_job_id = response.get("job_id")
+
+        return self.latest_job_id
+
+    def streamImage(self, img_bytes, progressive=False, encoding=None, retries=3, supersede=False):
+        """
+        Uploads an image for enhancement over the WebSocket, as a JSON header frame
+        followed by a binary frame, avoiding a HTTP request per image. Results come
+        back on the same connection as for `enhanceImage`.
+
+        Args:
+            img_bytes (bytes): The JPEG image data to be enhanced.
+            progressive (bool): Request a fast preview ahead of the full resolution
+                result.
+            encoding (dict): Output encoder settings for this job, overriding the
+                session configuration.
+            retries (int): Times the image is sent again after the server's
+                `retry_after` when its job queue is full.
+            supersede (bool): Latest wins, cancel the unfinished jobs of this session
+                and ignore their results.
+
+        Returns:
+            str: The job ID, chosen by the client so results can be matched before
+            the server acknowledges the upload.
+        """
+
+        job_id = uuid.uuid4().hex
+        self.uploads += 1
+
+        if supersede and self.latest_job_id is not None:
+            self.superseded_job_ids.append(self.latest_job_id)
+
+        header = {
+            "type": "enhance",
+            "job_id": job_id,
+            "image_type": "image/jpeg",
+            "progressive": progressive,
+            "supersede": supersede,
+            **(encoding or {}),
+        }
+        self.streamed[job_id] = {
+            "header": header,
+            "image": img_bytes,
+            "encoding": encoding,
+            "retries": retries,
+            "upload": self.uploads,
+            "reauthenticated": False,
+        }
+        self.latest_job_id = job_id
+
+        self._sendStream(job_id)
+
+        return job_id
+
+    def _sendStream(self, job_id: str):
+        stream = self.streamed.get(job_id)
+        if stream is None:
+            return
+
+        header = stream["header"]
+
+        if self.ws_open.is_set():
+            # The header and image frames must not interleave with another upload's
+            try:
+                with self._stream_lock:
+                    self.ws.send(json.dumps(header))
+                    self.ws.send(stream["image"], websocket.ABNF.OPCODE_BINARY)
+                return
+            except websocket.WebSocketConnectionClosedException:
+                self.ws_open.clear()
+            except Exception as e:
+                self.streamed.pop(job_id, None)
+                self.logger.exception(e)
+                return
+
+        # Without a connection the image is uploaded over HTTP instead
+        self.streamed.pop(job_id, None)
+        self.logger.info("WebSocket not connected, uploading over HTTP")
+        self.enhanceImage(stream["image"], header["progressive"], stream["encoding"], stream["retries"], header["supersede"])
+
+    def _resendStream(self, job_id: str):
+        """
+        Sends a streamed image again. A superseding image is dropped once it has
+        been superseded itself or a newer image was uploaded, so it can't cancel
+        the newer job.
+        """
+
+        stream = self.streamed.get(job_id)
+        if stream is None:
+            return
+
+        if stream["header"]["supersede"] and (job_id in self.superseded_job_ids or stream["upload"] != self.uploads):
+            self.streamed.pop(job_id, None)
+            self.logger.info("Dropping deferred image, a newer image was uploaded")
+            return
+
+        self._sendStream(job_id)
+
+    def _retryUpload(self, upload, img_bytes, progressive, encoding, retries, supersede):
+        """
+        Retries a deferred upload. A superseding upload is dropped once a newer
+        image has been uploaded, so it can't cancel the newer job.
+        """
+
+        if supersede and upload != self.uploads:
+            self.logger.info("Dropping deferred upload, a newer image was uploaded")
+            return
+
+        self.enhanceImage(img_bytes, progressive, encoding, retries, supersede)
 
     def getOptions(self) -> dict:
         """
@@ -214,6 +470,8 @@ class SeaingService:
             SeaingAPIClient.Endpoints.CONFIG,
             json={"config": config},
         )
+        self.config_version = response.get("config_version", self.config_version)
+
         return response
     
     def _reqChallenge(self) -> dict:
@@ -0,0 +1,161 @@
+"""
+COPYRIGHT: University of Sunshine Coast 2024
+
+AUTHOR: Joseph Thurlow <joseph.thurlow@protonmail.com>
+"""
+
+import math
+import os
+import threading
+import time
+from typing import NamedTuple
+
+
+class JobTicket(NamedTuple):
+    size: int
+    admitted_at: float
+
+
+class AdmissionController:
+    """
+    Bounds the jobs an execution backend holds, queued or running, by count and
+    by the bytes of their uploads.
+
+    A job is admitted before its upload is read into memory and released once it
+    completes, so a burst of uploads is turned away with a retry estimate instead
+    of piling up behind the workers. `precheck` turns an upload away before its
+    request body is even received.
+
+    Args:
+        max_jobs (int): Jobs admitted at once.
+        max_bytes (int): Upload bytes admitted at once. A single upload larger than
+            the whole budget is admitted while nothing else is.
+        smoothing (float): Weight of the newest job in the latency average.
+    """
+
+    def __init__(self, max_jobs: int, max_bytes: int, smoothing: float = 0.2):
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.smoothing = smoothing
+
+        self.jobs = 0
+        self.bytes = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.latency = None
+
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+        self._lock = threading.Lock()
+
+    def admit(self, size: int):
+        """
+        Admit a job.
+
+        Args:
+            size (int): Bytes of the upload, e.g. the request's content length.
+
+        Returns:
+            JobTicket: The ticket to `release` once the job completes, or None if
+            the queue is full.
+        """
+
+        size = size or 0
+
+        with self._lock:
+            if self._full(size):
+                self.rejected += 1
+                return None
+
+            self.jobs += 1
+            self.bytes += size
+            self.admitted += 1
+
+        return JobTicket(size, time.time())
+
+    def precheck(self, size: int) -> bool:
+        """
+        Check whether a job would be admitted now, without admitting it, so an upload
+        is turned away before its body is received. Jobs passing the check still go
+        through `admit` once their upload is parsed.
+
+        Args:
+            size (int): Bytes of the upload, e.g. the request's content length.
+
+        Returns:
+            bool: False, counted as a rejection, if the queue is full.
+        """
+
+        with self._lock:
+            if self._full(size or 0):
+                self.rejected += 1
+                return False
+
+        return True
+
+    def release(self, ticket: JobTicket):
+        latency = time.time() - ticket.admitted_at
+
+        with self._lock:
+            self.jobs -= 1
+            self.bytes -= ticket.size
+
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+
+    def observe_wait(self, seconds: float):
+        """
+        Record how long a job waited for a worker.
+        """
+
+        with self._lock:
+            self.waits += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def retry_after(self) -> int:
+        """
+        Seconds until a job slot is expected to free up, for `Retry-After`. Jobs
+        complete roughly every average latency divided by the jobs in flight.
+        """
+
+        with self._lock:
+            if self.latency is None or not self.jobs:
+                return 1
+
+            return max(1, math.ceil(self.latency / self.jobs))
+
+    def _full(self, size: int) -> bool:
+        # Called with the lock held
+        return self.jobs >= self.max_jobs or (self.jobs and self.bytes + size > self.max_bytes)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "depth": self.jobs,
+                "max_depth": self.max_jobs,
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "latency_avg": self.latency,
+                "wait_avg": self.wait_total / self.waits if self.waits else None,
+                "wait_max": self.wait_max,
+            }
+
+
+def create_admission_controller(max_workers: int) -> AdmissionController:
+    """
+    Create the admission controller configured by `JOB_QUEUE_DEPTH` (jobs queued
+    or running, default 4 per worker) and `JOB_QUEUE_MB` (upload bytes queued or
+    running, default 512).
+    """
+
+    max_jobs = int(os.environ.get("JOB_QUEUE_DEPTH", max_workers * 4))
+    max_bytes = int(float(os.environ.get("JOB_QUEUE_MB", 512)) * 1024 * 1024)
+
+    return AdmissionController(max_jobs, max_bytes)
@@ -4,14 +4,14 @@ COPYRIGHT: University of Sunshine Coast 2024
 AUTHOR: Joseph Thurlow <joseph.thurlow@protonmail.com>
 """
 
-import copy
 import hashlib
+import io
 import os
 import time
 import json
 import uuid
-import base64
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import CancelledError
+from functools import partial
 
 import pyotp
 from dotenv import load_dotenv
@@ -23,12 +23,14 @@ from flask import (
     request,
     session,
 )
-import threading
 
 from flask_sock import Sock
 from flask_session import Session
 
-from seaserver.processing import ImageEnhancer
+from seaserver.dispatch import OutboundMessage, create_client_registry
+from seaserver.jobs import JOB_CANCELLED, JOB_DONE, JOB_FAILED, JOB_SUPERSEDED, create_job_registry
+from seaserver.processing import ImageEnhancer, compile_plan, parse_flag, validate_config
+from seaserver.workers import create_backend
 
 load_dotenv()
 
@@ -48,16 +50,20 @@ app.config["SESSION_FILE_DIR"] = "./flask_session/"
 app.config["SESSION_PERMANENT"] = False
 app.config["SESSION_USE_SIGNER"] = True
 app.config["SESSION_KEY_PREFIX"] = "sc_"
+# Only store modified sessions, a WebSocket would otherwise write back the session it
+# read at the handshake when it closes, undoing later logins and configuration changes
+app.config["SESSION_REFRESH_EACH_REQUEST"] = False
 Session(app)
 
-executor = ThreadPoolExecutor()
+# Execution backend is selected at startup with EXECUTION_BACKEND (thread|process)
+backend = create_backend()
+jobs = create_job_registry(backend)
 img_enhancer = ImageEnhancer()
 
 
 # In-Memory Storage for Challenge Codes and WebSocket Clients
 challenge_storage = {}
-clients = {}
-clients_lock = threading.Lock()
+clients = create_client_registry()
 
 
 
@@ -135,39 +141,77 @@ def auth_check():
 
 # PROCESSOR
 
-def process_image_task(image_bytes, image_type, config, session_id):
+def process_image_task(image_bytes, image_type, plan, job, deadline=None, progressive=False, ticket=None):
     """
-    Background task for processing images using the ImageEnhancer.
-    Once processed, the result is sent back to the WebSocket client.
+    Submits an image to the execution backend for processing with the ImageEnhancer.
+    Once processed, the result is sent back to the WebSocket client. Progressive jobs
+    first send a preview processed on a downscaled proxy.
     """
 
+    future = backend.submit(image_bytes, image_type, plan, deadline, progressive, ticket)
+    jobs.attach(job, future)
+
+    if future.preview is not None:
+        future.preview.add_done_callback(partial(send_result, job, final_future=future))
+    future.add_done_callback(partial(send_result, job))
+
+
+def send_result(job, future, final_future=None):
+    """
+    Completion callback for processing jobs. Sends the enhanced image to the
+    WebSocket client registered for the job's session as a JSON header frame,
+    tagged with the job ID, followed by a binary frame holding the encoded image.
+    `final_future` is given for previews, which are dropped once the full
+    result is ready. Results of cancelled and superseded jobs are dropped.
+
+    The result is queued on the client's connection rather than sent, so a slow
+    client never holds up the worker or other clients.
+    """
+
+    preview = final_future is not None
+    status = JOB_FAILED
+
     try: 
-        img_encoded, duration_info, errors = img_enhancer.processImg(image_bytes, image_type, config)
-
-        if img_encoded is None: 
-            print("Error processing image")
-            return 
-        
-        image_base64 = base64.b64encode(img_encoded.tobytes()).decode('utf-8')
-
-        with clients_lock:
-            print(f"Sending result to client {clients}")
-            if session_id in clients:
-                
-                print("Client found")
-                ws = clients[session_id]
-                result_message = {
-                    "message": "Image processed successfully",
-                    "image": image_base64,
-                    "duration": duration_info,
-                    "errors": errors,
-                }
-                
-                ws.send(json.dumps(result_message))
-    
+        with backend.result(future) as (img_encoded, duration_info, errors):
+            if job.status in (JOB_CANCELLED, JOB_SUPERSEDED) or (preview and final_future.done()):
+                return
+
+            if img_encoded is None: 
+                print("Error processing image")
+                return 
+            
+            status = JOB_DONE
+            # The result may live in a shared slot that is released with the context
+            image_bytes = bytes(img_encoded)
+
+        connection = clients.get(job.session_id)
+        if connection is None:
+            print(f"Client {job.session_id} not connected, dropping result")
+            return
+
+        result_header = {
+            "type": "result",
+            "message": "Image processed successfully",
+            "job_id": job.job_id,
+            "preview": preview,
+            "image_size": len(image_bytes),
+            "duration": duration_info,
+            "errors": errors,
+        }
+
+        # A queued preview is replaced by its full result
+        connection.send(OutboundMessage((json.dumps(result_header), image_bytes), job.job_id, preview))
+
+    except CancelledError:
+        pass
+
     except Exception as e:
         print(f"Error processing image: {e}")
 
+    finally:
+        if not preview:
+            jobs.finish(job, status)
+
 
 # APP ROUTES
 
@@ -180,11 +224,152 @@ def index():
     return render_template("index.html")
 
 
+def submit_job(config, fields, owner, session_id, image_stream, image_type, upload_size, job_id=None):
+    """
+    Validates, admits and submits an enhancement job. Shared by the HTTP and
+    WebSocket uploads.
+
+    Args:
+        config (dict): The session configuration.
+        fields: The job's optional fields, the upload form or a WebSocket header.
+        owner (str): The authenticated session submitting the job.
+        session_id (str): The WebSocket session results are sent to.
+        image_stream: Binary stream of the encoded image.
+        image_type (str): The image's MIME type.
+        upload_size (int): Bytes of the upload, for admission.
+        job_id (str): ID chosen by the client, generated when not given.
+
+    Returns:
+        tuple: The submitted job and None, or None and the `(body, status, headers)`
+        of the error response.
+    """
+
+    try:
+        # Output encoder settings given with the job override the session's
+        overrides = {
+            "output_format": fields.get("output_format"),
+            "output_quality": fields.get("output_quality"),
+            "jpeg_progressive": fields.get("jpeg_progressive"),
+            "png_compression": fields.get("png_compression"),
+        }
+        # Form values are strings, `output_settings` parses and validates them
+        overrides = {name: value for name, value in overrides.items() if value is not None}
+
+        # Plans are immutable, so later changes to the session config don't affect the job
+        plan = compile_plan({**config, **overrides})
+
+        # Optional latency budget, stages are degraded to deliver the result within it
+        deadline_ms = fields.get("deadline_ms")
+        deadline = time.time() + float(deadline_ms) / 1000 if deadline_ms else None
+
+        # Progressive jobs send a fast preview before the full resolution result
+        progressive = parse_flag(fields.get("progressive", False))
+        supersede = parse_flag(fields.get("supersede", False))
+    except (TypeError, ValueError) as e:
+        return None, ({"error": str(e)}, 400, {})
+
+    # Latest wins, a superseding upload cancels the session's unfinished jobs
+    if supersede:
+        jobs.supersede(owner, session_id)
+
+    # Admit the job before its upload is read into memory
+    ticket = backend.admission.admit(upload_size)
+    if ticket is None:
+        return None, queue_full_error()
+
+    try:
+        job = jobs.create(owner, session_id, job_id)
+    except ValueError as e:
+        backend.admission.release(ticket)
+        return None, ({"error": str(e)}, 409, {})
+
+    try:
+        image_bytes = backend.read_upload(image_stream)
+        process_image_task(image_bytes, image_type, plan, job, deadline, progressive, ticket)
+    except Exception:
+        backend.admission.release(ticket)
+        jobs.finish(job, JOB_FAILED)
+        raise
+
+    return job, None
+
+
+def queue_full_error():
+    """
+    The `(body, status, headers)` of the 429 response when the job queue is full.
+    """
+
+    retry_after = backend.admission.retry_after()
+    return {"error": "Too many images queued", "retry_after": retry_after}, 429, {"Retry-After": str(retry_after)}
+
+
+def send_message(connection, message: dict):
+    """
+    Queues a JSON text frame for a WebSocket client.
+    """
+
+    connection.send(OutboundMessage((json.dumps(message),)))
+
+
+def receive_upload(connection, session_id, header, image_bytes):
+    """
+    Submits an image uploaded over the WebSocket and acknowledges it with an
+    `accepted` or `rejected` frame.
+
+    The session is read again for every upload, so a logout or an expired
+    session stops the socket's uploads and configuration changes apply to the
+    next image.
+
+    Args:
+        connection (ClientConnection): The client's connection.
+        session_id (str): The WebSocket session.
+        header (dict): The upload's header frame.
+        image_bytes (bytes): The upload's binary frame.
+    """
+
+    job_id = header.get("job_id")
+
+    def reject(error, status, retry_after=None):
+        send_message(connection, {"type": "rejected", "job_id": job_id, "status": status, "error": error, "retry_after": retry_after})
+
+    stored = app.session_interface.open_session(app, request)
+    if stored is None or not stored.get("authenticated"):
+        return reject("Unauthorized", 401)
+
+    config = stored.get("config")
+    if not config:
+        return reject("Configuration not set", 400)
+
+    job, error = submit_job(
+        config,
+        header,
+        stored.sid,
+        session_id,
+        io.BytesIO(image_bytes),
+        header.get("image_type", "image/jpeg"),
+        len(image_bytes),
+        job_id,
+    )
+
+    if error is not None:
+        body, status, _ = error
+        return reject(body["error"], status, body.get("retry_after"))
+
+    send_message(connection, {"type": "accepted", "job_id": job.job_id, "config_version": stored.get("config_version", 0)})
+
+
 @sockets.route('/updates')
 def updates_socket(ws):
     """
     WebSocket route for handling client connections. It allows real-time communication
     with clients for sending image processing updates.
+
+    Authenticated clients (the handshake carries the session cookie) can also upload
+    images on the socket as an `enhance` JSON header frame followed by a binary
+    frame holding the encoded image, avoiding a HTTP request per image.
+
+    Frames to the client are sent by the connection's own sender (refer
+    `dispatch.ClientConnection`), while this handler only receives.
     """
 
     session_id = request.args.get("session_id")
@@ -192,19 +377,41 @@ def updates_socket(ws):
         ws.close()
         return
 
-    clients[session_id] = ws
+    connection = clients.connect(session_id, ws)
+
+    header = None
     
-    print(f"Starting client {clients}")
+    print(f"Starting client {session_id}")
     try:
         while True:
-            print("socketing")
             message = ws.receive()
             if message is None:
                 break
 
+            if isinstance(message, str):
+                try:
+                    data = json.loads(message)
+                except ValueError:
+                    continue
+
+                header = data if isinstance(data, dict) and data.get("type") == "enhance" else None
+                continue
+
+            if header is None:
+                send_message(connection, {"type": "rejected", "job_id": None, "status": 400, "error": "Image frame without a header"})
+                continue
+
+            # A failed upload is reported on the socket rather than closing it
+            try:
+                receive_upload(connection, session_id, header, message)
+            except Exception as e:
+                print(f"Error receiving image: {e}")
+                send_message(connection, {"type": "rejected", "job_id": header.get("job_id"), "status": 500, "error": "Unable to process image"})
+            header = None
+
     finally:
-        print(f"closing client {clients}")
-        clients.pop(session_id, None)
+        print(f"Closing client {session_id}")
+        clients.disconnect(session_id, connection)
 
 
 @app.route("/image/enhance", methods=["POST"])
@@ -220,8 +427,13 @@ def enhance_image():
 
     if not config:
         return jsonify({"error": "Configuration not set"}), 400
-    
-    config_copy = copy.deepcopy(config)
+
+    # Touching the form makes Werkzeug receive and parse the whole body, so a full
+    # queue turns the upload away by its Content-Length first
+    if not backend.admission.precheck(request.content_length):
+        body, status, headers = queue_full_error()
+        return jsonify(body), status, headers
+
     image_file = request.files.get("file")
 
     session_id = request.form.get("session_id")
@@ -230,13 +442,53 @@ def enhance_image():
 
     if not image_file:
         return jsonify({"error": "Image file is required"}), 400
-    
-    image_bytes = image_file.read()
-    image_type = image_file.content_type
 
-    executor.submit(process_image_task, image_bytes, image_type, config_copy, session_id)
+    job, error = submit_job(
+        config,
+        request.form,
+        session.sid,
+        session_id,
+        image_file.stream,
+        image_file.content_type,
+        request.content_length,
+    )
 
-    return jsonify({"message": "Processing started"}), 202
+    if error is not None:
+        body, status, headers = error
+        return jsonify(body), status, headers
+
+    return jsonify({"message": "Processing started", "job_id": job.job_id}), 202
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """
+    Route to get the status of an enhancement job: queued, running, done, failed,
+    cancelled or superseded.
+    """
+
+    auth_check()
+
+    # Jobs are only visible to the session that submitted them
+    job = jobs.get(session.sid, job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    return jsonify(jobs.status(job)), 200
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    """
+    Route to cancel an enhancement job. Queued jobs are dropped and running jobs
+    are abandoned at their next stage. Finished jobs are left as they are.
+    """
+
+    auth_check()
+
+    job = jobs.cancel(session.sid, job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    return jsonify(jobs.status(job)), 200
 
 @app.route("/config", methods=["POST"])
 def config():
@@ -248,24 +500,44 @@ def config():
 
     config:dict = request.json.get("config")
 
+    try:
+        validate_config(config)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     session["config"] = config
+    # Reported in the `accepted` frame, so WebSocket clients can tell which configuration an upload ran with
+    session["config_version"] = session.get("config_version", 0) + 1
 
-    return jsonify({"message": "Configuration set"})
+    return jsonify({"message": "Configuration set", "config_version": session["config_version"]})
 
 @app.route("/options", methods=["GET"])
 def options():
     """
-    Route to get available image enhancement options. Returns a list of enhancements.
+    Route to get available image enhancement options. Returns a list of enhancements
+    and the settings they accept.
     """
 
     auth_check()
 
     enhancement_data = img_enhancer.getAvailableEnhancements()
+    settings_data = img_enhancer.getAvailableSettings()
 
-    response = {"enhancements": enhancement_data}
+    response = {"enhancements": enhancement_data, "settings": settings_data}
 
     return jsonify(response), 200
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Route to get server metrics: the execution backend, result cache and buffer
+    pool high-water marks, and the WebSocket clients' outbound queues.
+    """
+
+    auth_check()
+
+    return jsonify({**backend.metrics(), "clients": clients.stats()}), 200
+
 @app.route("/logout", methods=["POST"])
 def logout():
     """
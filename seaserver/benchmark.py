@@ -0,0 +1,172 @@
+"""
+Throughput benchmark for the SeaServer execution backends.
+
+From the project root:
+
+    python -m seaserver.benchmark backends --image path/to/frame.jpg --jobs 32
+
+Each execution backend is started, warmed up with one job per worker, and then
+handed `--jobs` concurrent enhancement jobs. Reported figures are wall-clock
+throughput and the mean per-job latency.
+
+    python -m seaserver.benchmark clahe --image path/to/frame.jpg
+
+Times each adaptive histogram equalisation backend and reports its parity with
+the skimage backend (mean/max absolute difference in grey levels and PSNR).
+"""
+
+import argparse
+import io
+import os
+import time
+from concurrent.futures import wait
+from functools import partial
+
+import cv2
+import numpy as np
+
+from seaserver.processing import Frame, ImageEnhancer, ProcessingContext, convert_image, decode_img
+from seaserver.workers import BACKENDS, create_backend
+
+DEFAULT_CONFIG = {
+    "laplacian_variance": True,
+    "white_balance": True,
+    "super_res_upscale": False,
+    "richard_lucy_deconvolution": True,
+    "adaptive_histograph_equalisation": True,
+}
+
+
+def synthetic_image(width: int = 800, height: int = 600) -> bytes:
+    """
+    Build a smooth, noisy, blue-tinted test frame when no image is supplied.
+    """
+
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 255, (height // 16, width // 16, 3), dtype=np.uint8)
+    img = cv2.resize(base, (width, height), interpolation=cv2.INTER_CUBIC)
+    img = cv2.GaussianBlur(img, (5, 5), 1.5)
+    img[:, :, 0] = cv2.add(img[:, :, 0], 40)
+
+    _, img_encoded = cv2.imencode(".jpg", img)
+    return img_encoded.tobytes()
+
+
+def run_backend(name: str, image_bytes: bytes, jobs: int, workers: int, config: dict) -> dict:
+    # Every job is the same upload, so the result and pipeline caches would answer all
+    # but the first. The pipeline cache is read from the environment by each enhancer,
+    # including those of spawned worker processes.
+    os.environ["PIPELINE_CACHE_MB"] = "0"
+    backend = create_backend(name, workers)
+    backend.cache = None
+
+    try:
+        # Warm-up so process start-up and model loading are not measured
+        warm_up = [backend.submit(backend.read_upload(io.BytesIO(image_bytes)), "image/jpeg", config) for _ in range(backend.max_workers)]
+        for future in warm_up:
+            with backend.result(future):
+                pass
+
+        latencies = []
+        start = time.perf_counter()
+
+        def record(submitted_at, _future):
+            latencies.append(time.perf_counter() - submitted_at)
+
+        futures = []
+        for _ in range(jobs):
+            submitted_at = time.perf_counter()
+            future = backend.submit(backend.read_upload(io.BytesIO(image_bytes)), "image/jpeg", config)
+            future.add_done_callback(partial(record, submitted_at))
+            futures.append(future)
+
+        wait(futures)
+        elapsed = time.perf_counter() - start
+
+        for future in futures:
+            with backend.result(future):
+                pass
+    finally:
+        backend.shutdown()
+
+    return {
+        "backend": name,
+        "workers": backend.max_workers,
+        "jobs": jobs,
+        "seconds": elapsed,
+        "images_per_sec": jobs / elapsed,
+        "mean_latency": sum(latencies) / len(latencies),
+    }
+
+
+def clahe_report(image_bytes: bytes, repeats: int = 5) -> list[dict]:
+    enhancer = ImageEnhancer()
+    image = decode_img(image_bytes, "image/jpeg")
+    equalise = ImageEnhancer.adaptive_histograph_equalisation.__wrapped__
+
+    def run(stage_image, clahe_backend):
+        # A fresh frame per run so cached views don't hide conversion costs
+        ctx = ProcessingContext(frame=Frame(stage_image))
+        return equalise(enhancer, stage_image, ctx, clahe_backend=clahe_backend)
+
+    results = []
+    reference = None
+    for clahe_backend in ("skimage", "opencv", "opencv_lab"):
+        stage_image = convert_image(image, np.float32 if clahe_backend == "skimage" else np.uint8)
+        run(stage_image, clahe_backend)
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            output = convert_image(run(stage_image, clahe_backend), np.uint8)
+        elapsed = (time.perf_counter() - start) / repeats
+
+        if reference is None:
+            reference = output
+
+        diff = np.abs(output.astype(np.int16) - reference)
+        results.append({
+            "backend": clahe_backend,
+            "ms": elapsed * 1000,
+            "mean_diff": float(diff.mean()),
+            "max_diff": int(diff.max()),
+            "psnr": cv2.PSNR(output, reference),
+        })
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SeaServer benchmarks")
+    parser.add_argument("report", nargs="?", default="backends", choices=["backends", "clahe"])
+    parser.add_argument("--image", help="JPEG to enhance, a synthetic 800x600 frame is used if omitted")
+    parser.add_argument("--jobs", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS))
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, "rb") as f:
+            image_bytes = f.read()
+    else:
+        image_bytes = synthetic_image()
+
+    if args.report == "clahe":
+        print(f"{'backend':<12}{'ms':>8}{'mean diff':>11}{'max diff':>10}{'psnr':>8}")
+        for res in clahe_report(image_bytes):
+            print(
+                f"{res['backend']:<12}{res['ms']:>8.1f}{res['mean_diff']:>11.2f}"
+                f"{res['max_diff']:>10}{res['psnr']:>8.1f}"
+            )
+        return
+
+    print(f"{'backend':<10}{'workers':>8}{'jobs':>6}{'seconds':>10}{'img/s':>8}{'latency':>10}")
+    for name in args.backends:
+        res = run_backend(name, image_bytes, args.jobs, args.workers, DEFAULT_CONFIG)
+        print(
+            f"{res['backend']:<10}{res['workers']:>8}{res['jobs']:>6}"
+            f"{res['seconds']:>10.2f}{res['images_per_sec']:>8.2f}{res['mean_latency']:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+COPYRIGHT: University of Sunshine Coast 2024
+
+AUTHOR: Joseph Thurlow <joseph.thurlow@protonmail.com>
+"""
+
+import os
+import threading
+from collections import deque
+
+
+class OutboundMessage:
+    """
+    Frames sent to a client back to back, e.g. a result's JSON header and its
+    binary image frame, so they are never interleaved with another message's.
+
+    Attributes:
+        frames (tuple): The frames, `str` for text and `bytes` for binary frames.
+        key (str): Messages with the same key replace each other while queued,
+            e.g. the preview and full result of a job.
+        preview (bool): Previews are dropped first when the queue is full, and never
+            replace a queued full result.
+    """
+
+    def __init__(self, frames, key: str = None, preview: bool = False):
+        self.frames = tuple(frames)
+        self.key = key
+        self.preview = preview
+        self.size = sum(len(frame) for frame in self.frames)
+
+
+class ClientConnection:
+    """
+    A WebSocket client with its own bounded outbound queue and sender thread, so
+    a slow link only delays its own messages and never the workers that produce
+    them.
+
+    When the queue is over `max_messages` or `max_bytes`, stale messages are
+    dropped, queued previews first and then the oldest, instead of blocking the
+    producer.
+
+    Args:
+        ws: The client's WebSocket.
+        max_messages (int): Messages queued at once.
+        max_bytes (int): Bytes of the frames queued at once.
+    """
+
+    def __init__(self, ws, max_messages: int, max_bytes: int):
+        self.ws = ws
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+        self.bytes = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+        self.retired = False
+
+        self._queue = deque()
+        self._ready = threading.Condition()
+        self._sender = threading.Thread(target=self._run, daemon=True)
+        self._sender.start()
+
+    def send(self, message: OutboundMessage) -> bool:
+        """
+        Queue a message for the client without waiting for it to be sent.
+
+        Returns:
+            bool: False if the message was dropped, as the connection is closed,
+            the full result it would replace is already queued, or it is a preview
+            and the queue is full of full results.
+        """
+
+        with self._ready:
+            if self.closed:
+                return False
+
+            if message.key is not None:
+                for queued in self._queue:
+                    if queued.key != message.key:
+                        continue
+
+                    if message.preview and not queued.preview:
+                        self.coalesced += 1
+                        return False
+
+                    self._queue.remove(queued)
+                    self.bytes -= queued.size
+                    self.coalesced += 1
+                    break
+
+            self._queue.append(message)
+            self.bytes += message.size
+
+            while len(self._queue) > 1 and (len(self._queue) > self.max_messages or self.bytes > self.max_bytes):
+                stale = next((queued for queued in self._queue if queued.preview), self._queue[0])
+
+                self._queue.remove(stale)
+                self.bytes -= stale.size
+                self.dropped += 1
+
+                # A preview never pushes out a full result, it is dropped itself
+                if stale is message:
+                    return False
+
+            self._ready.notify()
+
+        return True
+
+    def close(self):
+        """
+        Stop the sender, discarding the messages still queued.
+        """
+
+        with self._ready:
+            self.closed = True
+            self.bytes = 0
+            self._queue.clear()
+            self._ready.notify()
+
+    def stats(self) -> dict:
+        with self._ready:
+            return {
+                "queued": len(self._queue),
+                "bytes": self.bytes,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+            }
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._queue and not self.closed:
+                    self._ready.wait()
+
+                if self.closed:
+                    return
+
+                message = self._queue.popleft()
+                self.bytes -= message.size
+
+            # The queue lock is not held while the link is slow
+            try:
+                for frame in message.frames:
+                    self.ws.send(frame)
+            except Exception as e:
+                print(f"Error sending to client: {e}")
+                self.close()
+                return
+
+            with self._ready:
+                self.sent += 1
+
+
+class ClientRegistry:
+    """
+    The connected WebSocket clients by session ID.
+
+    Producers look up a session's connection and queue on it, the registry's lock
+    is only held to connect and disconnect clients.
+
+    Args:
+        max_messages (int): Outbound messages queued per client.
+        max_bytes (int): Outbound bytes queued per client.
+    """
+
+    def __init__(self, max_messages: int, max_bytes: int):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+        self.dropped = 0
+        self.coalesced = 0
+        self.sent = 0
+
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def connect(self, session_id: str, ws) -> ClientConnection:
+        """
+        Register the WebSocket of a session, replacing any previous connection.
+        """
+
+        connection = ClientConnection(ws, self.max_messages, self.max_bytes)
+
+        with self._lock:
+            previous = self._clients.get(session_id)
+            self._clients[session_id] = connection
+
+        if previous is not None:
+            self._retire(previous)
+
+        return connection
+
+    def disconnect(self, session_id: str, connection: ClientConnection):
+        """
+        Unregister a connection, unless the session has since reconnected.
+        """
+
+        with self._lock:
+            if self._clients.get(session_id) is connection:
+                del self._clients[session_id]
+
+        self._retire(connection)
+
+    def get(self, session_id: str) -> ClientConnection:
+        # A dict lookup is atomic, so producers don't contend on the lock
+        return self._clients.get(session_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            connections = list(self._clients.values())
+            totals = {"dropped": self.dropped, "coalesced": self.coalesced, "sent": self.sent}
+
+        stats = {"connections": len(connections), "queued": 0, "bytes": 0, **totals}
+        for connection in connections:
+            for name, value in connection.stats().items():
+                stats[name] += value
+
+        return stats
+
+    def _retire(self, connection: ClientConnection):
+        connection.close()
+
+        stats = connection.stats()
+        with self._lock:
+            if connection.retired:
+                return
+
+            connection.retired = True
+            self.dropped += stats["dropped"]
+            self.coalesced += stats["coalesced"]
+            self.sent += stats["sent"]
+
+
+def create_client_registry() -> ClientRegistry:
+    """
+    Create the client registry, queueing up to `OUTBOUND_QUEUE_DEPTH` messages
+    (default 8) and `OUTBOUND_QUEUE_MB` (default 64) per client.
+    """
+
+    max_messages = int(os.environ.get("OUTBOUND_QUEUE_DEPTH", 8))
+    max_bytes = int(float(os.environ.get("OUTBOUND_QUEUE_MB", 64)) * 1024 * 1024)
+
+    return ClientRegistry(max_messages, max_bytes)
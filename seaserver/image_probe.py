@@ -0,0 +1,143 @@
+"""
+COPYRIGHT: University of Sunshine Coast 2024
+
+AUTHOR: Joseph Thurlow <joseph.thurlow@protonmail.com>
+"""
+
+import struct
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# JPEG start of frame markers, which carry the image dimensions. C4 (DHT), C8 (JPG)
+# and CC (DAC) share the range but are not frames.
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# JPEG markers without a length field
+JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xDA)) | {0x01}
+
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+
+
+def probe_dimensions(img_bytes, img_format: str):
+    """
+    Read the dimensions of an encoded image from its header, without decoding or
+    allocating the pixels.
+
+    Args:
+        img_bytes: The encoded image, any object supporting the buffer protocol.
+        img_format (str): The image's MIME type.
+
+    Returns:
+        tuple: `(width, height)`, or None if the format is unsupported or the
+        header is malformed.
+    """
+
+    probe = PROBES.get(img_format)
+    if probe is None:
+        return None
+
+    data = memoryview(img_bytes).cast("B")
+    try:
+        return probe(data)
+    except (struct.error, IndexError):
+        return None
+
+
+def _probe_jpeg(data):
+    if data[:2] != b"\xff\xd8":
+        return None
+
+    index = 2
+    while index < len(data):
+        if data[index] != 0xFF:
+            return None
+
+        # Markers may be preceded by any number of fill bytes
+        while index < len(data) and data[index] == 0xFF:
+            index += 1
+        marker = data[index]
+
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from(">HH", data, index + 4)
+            return width, height
+
+        # Scan data follows the start of scan, so no frame header was found
+        if marker == 0xDA or marker == 0xD9:
+            return None
+
+        if marker in JPEG_STANDALONE_MARKERS:
+            index += 1
+            continue
+
+        (length,) = struct.unpack_from(">H", data, index + 1)
+        index += 1 + length
+
+    return None
+
+
+def _probe_png(data):
+    if data[:8] != PNG_SIGNATURE or data[12:16] != b"IHDR":
+        return None
+
+    return struct.unpack_from(">II", data, 16)
+
+
+def _probe_webp(data):
+    if data[:4] != b"RIFF" or data[8:12] != b"WEBP":
+        return None
+
+    chunk = bytes(data[12:16])
+
+    # Lossy, the frame header follows a 3 byte frame tag and the 9D 01 2A start code
+    if chunk == b"VP8 ":
+        width, height = struct.unpack_from("<HH", data, 26)
+        return width & 0x3FFF, height & 0x3FFF
+
+    # Lossless, 14 bit dimensions minus one after the 0x2F signature
+    if chunk == b"VP8L":
+        (bits,) = struct.unpack_from("<I", data, 21)
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+
+    # Extended, 24 bit canvas dimensions minus one after the flags
+    if chunk == b"VP8X":
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return width, height
+
+    return None
+
+
+def _probe_tiff(data):
+    if data[:4] == b"II*\x00":
+        order = "<"
+    elif data[:4] == b"MM\x00*":
+        order = ">"
+    else:
+        return None
+
+    (ifd,) = struct.unpack_from(order + "I", data, 4)
+    (count,) = struct.unpack_from(order + "H", data, ifd)
+
+    dimensions = {}
+    for entry in range(ifd + 2, ifd + 2 + count * 12, 12):
+        tag, field_type = struct.unpack_from(order + "HH", data, entry)
+        if tag not in (TIFF_IMAGE_WIDTH, TIFF_IMAGE_LENGTH):
+            continue
+
+        # SHORT (3) or LONG (4), stored in the entry's value field
+        value_format = "H" if field_type == 3 else "I"
+        (dimensions[tag],) = struct.unpack_from(order + value_format, data, entry + 8)
+
+    if len(dimensions) != 2:
+        return None
+
+    return dimensions[TIFF_IMAGE_WIDTH], dimensions[TIFF_IMAGE_LENGTH]
+
+
+PROBES = {
+    "image/jpeg": _probe_jpeg,
+    "image/png": _probe_png,
+    "image/webp": _probe_webp,
+    "image/tiff": _probe_tiff,
+}
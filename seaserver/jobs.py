@@ -0,0 +1,189 @@
+"""
+COPYRIGHT: University of Sunshine Coast 2024
+
+AUTHOR: Joseph Thurlow <joseph.thurlow@protonmail.com>
+"""
+
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+JOB_SUPERSEDED = "superseded"
+
+FINISHED_STATUSES = frozenset({JOB_DONE, JOB_FAILED, JOB_CANCELLED, JOB_SUPERSEDED})
+
+
+class Job:
+    """
+    An enhancement job submitted through `/image/enhance` or the WebSocket.
+
+    Attributes:
+        job_id (str): The ID returned to the client and tagged on its results.
+        owner (str): The authenticated session that submitted the job, the only one
+            allowed to query or cancel it.
+        session_id (str): The WebSocket session results are sent to.
+        future (Future): The backend future of the full job, set once submitted.
+        status (str): Set once the job finishes, see `JobRegistry.status`.
+    """
+
+    def __init__(self, owner: str, session_id: str, job_id: str = None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.owner = owner
+        self.session_id = session_id
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.future: Future = None
+        self.status = JOB_QUEUED
+
+
+class JobRegistry:
+    """
+    Tracks jobs by owner and ID for the status and cancel endpoints and applies
+    the "latest wins" policy, where a newer upload supersedes the unfinished jobs
+    of its session. Job IDs, including those chosen by clients, are scoped to
+    their owner. Queued jobs are dropped and running jobs are abandoned
+    at their next stage boundary (refer `ExecutionBackend.cancel`).
+
+    Finished jobs are kept for status queries, up to `history` of them.
+
+    Args:
+        backend (ExecutionBackend): The backend the jobs are submitted to.
+        history (int): Finished jobs kept.
+    """
+
+    def __init__(self, backend, history: int = 1024):
+        self.backend = backend
+        self.history = history
+
+        self._jobs = OrderedDict()
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def create(self, owner: str, session_id: str, job_id: str = None) -> Job:
+        """
+        Register a new job for a session.
+
+        Args:
+            owner (str): The authenticated session submitting the job.
+            session_id (str): The WebSocket session of the job.
+            job_id (str): ID chosen by the client, generated when not given.
+
+        Raises:
+            ValueError: If the owner already has a job with the ID.
+        """
+
+        job = Job(owner, session_id, job_id)
+
+        with self._lock:
+            if (owner, job.job_id) in self._jobs:
+                raise ValueError(f"Job ID '{job.job_id}' is already in use")
+
+            self._active.setdefault((owner, session_id), {})[job.job_id] = job
+            self._jobs[owner, job.job_id] = job
+
+        return job
+
+    def supersede(self, owner: str, session_id: str):
+        """
+        Cancel the owner's unfinished jobs of a session, ahead of a newer one.
+        """
+
+        with self._lock:
+            superseded = list(self._active.get((owner, session_id), {}).values())
+
+        for job in superseded:
+            self._cancel(job, JOB_SUPERSEDED)
+
+    def attach(self, job: Job, future: Future):
+        """
+        Attach the backend future of a submitted job, cancelling it straight away
+        if the job was cancelled while being submitted.
+        """
+
+        with self._lock:
+            job.future = future
+            cancelled = job.status in FINISHED_STATUSES
+
+        if cancelled:
+            self.backend.cancel(future)
+
+    def get(self, owner: str, job_id: str) -> Job:
+        with self._lock:
+            return self._jobs.get((owner, job_id))
+
+    def cancel(self, owner: str, job_id: str) -> Job:
+        """
+        Cancel a job.
+
+        Returns:
+            Job: The job, or None if the owner has no job with the ID.
+        """
+
+        job = self.get(owner, job_id)
+        if job is not None:
+            self._cancel(job, JOB_CANCELLED)
+
+        return job
+
+    def finish(self, job: Job, status: str):
+        """
+        Record a job's final status. Jobs already cancelled or superseded keep
+        that status.
+        """
+
+        with self._lock:
+            if job.status not in FINISHED_STATUSES:
+                job.status = status
+                job.finished_at = time.time()
+
+            active_key = (job.owner, job.session_id)
+            self._active.get(active_key, {}).pop(job.job_id, None)
+            if not self._active.get(active_key, True):
+                del self._active[active_key]
+
+            self._trim()
+
+    def status(self, job: Job) -> dict:
+        status = job.status
+        if status not in FINISHED_STATUSES and job.future is not None and job.future.running():
+            status = JOB_RUNNING
+
+        return {
+            "job_id": job.job_id,
+            "status": status,
+            "submitted_at": job.submitted_at,
+            "finished_at": job.finished_at,
+        }
+
+    def _cancel(self, job: Job, status: str):
+        with self._lock:
+            if job.status in FINISHED_STATUSES:
+                return
+
+            job.status = status
+            job.finished_at = time.time()
+
+        if job.future is not None:
+            self.backend.cancel(job.future)
+
+    def _trim(self):
+        # Called with the lock held, only finished jobs are dropped
+        finished = [key for key, job in self._jobs.items() if job.status in FINISHED_STATUSES]
+        for key in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[key]
+
+
+def create_job_registry(backend) -> JobRegistry:
+    """
+    Create the job registry, keeping `JOB_HISTORY` (default 1024) finished jobs.
+    """
+
+    return JobRegistry(backend, int(os.environ.get("JOB_HISTORY", 1024)))
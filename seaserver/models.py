@@ -0,0 +1,364 @@
+"""
+COPYRIGHT: University of Sunshine Coast 2024
+
+AUTHOR: Joseph Thurlow <joseph.thurlow@protonmail.com>
+"""
+
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+models_dir = os.path.join(current_dir, "static/models")
+
+DEFAULT_MODEL = "espcn_x2"
+
+# Models preloaded and warmed up when a worker starts, comma separated
+PRELOAD_MODELS = [name for name in os.environ.get("SUPER_RES_PRELOAD", DEFAULT_MODEL).split(",") if name]
+
+# Micro-batching of concurrent super-resolution requests, a batch size of 1 disables it
+SUPER_RES_BATCH_SIZE = int(os.environ.get("SUPER_RES_BATCH_SIZE", 4))
+SUPER_RES_BATCH_WAIT_MS = float(os.environ.get("SUPER_RES_BATCH_WAIT_MS", 5))
+
+
+class ModelInfo(NamedTuple):
+    algorithm: str
+    scale: int
+    path: str
+
+
+def find_models(directory: str = models_dir) -> dict[str, ModelInfo]:
+    """
+    Find the super-resolution models in a directory. Models follow OpenCV's
+    `<ALGORITHM>_x<SCALE>.pb` naming, e.g. `FSRCNN_x4.pb` is registered as `fsrcnn_x4`.
+    """
+
+    models = {}
+    for filename in sorted(os.listdir(directory)):
+        match = re.fullmatch(r"([A-Za-z]+)_x(\d+)\.pb", filename)
+        if match:
+            algorithm, scale = match.group(1).lower(), int(match.group(2))
+            models[f"{algorithm}_x{scale}"] = ModelInfo(algorithm, scale, os.path.join(directory, filename))
+
+    return models
+
+
+AVAILABLE_MODELS = find_models()
+
+
+class SuperResModelManager:
+    """
+    Lazily loads super-resolution models and keeps one instance per thread.
+
+    `DnnSuperResImpl` is not safe for concurrent `upsample` calls, so every worker
+    thread (and therefore every worker process) gets its own instances. Each thread
+    keeps at most `max_models` models, least recently used first. Models idle for
+    longer than `idle_timeout` seconds are evicted from every thread by `evictIdle`,
+    which runs whenever any thread gets a model or starts a job, so a thread that
+    stops receiving super-resolution jobs doesn't keep its models. Newly loaded
+    models run a warm-up inference so the first real request doesn't pay for DNN
+    initialisation.
+
+    Args:
+        models (dict): Available models by name, see `find_models`.
+        max_models (int): Maximum number of models loaded per thread.
+        idle_timeout (float): Seconds after which an unused model is evicted.
+    """
+
+    def __init__(self, models: dict[str, ModelInfo] = None, max_models: int = 2, idle_timeout: float = 600):
+        self.models = AVAILABLE_MODELS if models is None else models
+        self.max_models = max_models
+        self.idle_timeout = idle_timeout
+        self._local = threading.local()
+
+        # Every thread's loaded models by thread ID, so idle models are evicted from
+        # threads that no longer ask for them
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str = DEFAULT_MODEL):
+        """
+        Get the calling thread's instance of a model, loading it if needed.
+
+        Raises:
+            ValueError: If the model is not available.
+        """
+
+        if name not in self.models:
+            raise ValueError(f"Unknown super-resolution model '{name}', expected one of {list(self.models)}")
+
+        now = time.monotonic()
+        self.evictIdle(now)
+
+        loaded = self._loaded()
+        with self._lock:
+            model, _ = loaded.pop(name, (None, None))
+
+        # Loading takes a while, other threads are not held up
+        if model is None:
+            model = self._load(self.models[name])
+
+        with self._lock:
+            loaded[name] = (model, now)
+            while len(loaded) > self.max_models:
+                loaded.popitem(last=False)
+
+        return model
+
+    def evictIdle(self, now: float = None):
+        """
+        Drop the models of every thread that have been idle for longer than
+        `idle_timeout`. A model in use keeps running, it is only released once done.
+        """
+
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            for loaded in self._threads.values():
+                for name in [n for n, (_, last_used) in loaded.items() if now - last_used > self.idle_timeout]:
+                    del loaded[name]
+
+    def upsample(self, image: np.ndarray, name: str = DEFAULT_MODEL) -> np.ndarray:
+        return self.get(name).upsample(image)
+
+    def preload(self, names: list[str] = None):
+        """
+        Load and warm up models for the calling thread.
+        """
+
+        for name in PRELOAD_MODELS if names is None else names:
+            self.get(name)
+
+    def loaded(self) -> list[str]:
+        """
+        Names of the models loaded by the calling thread, least recently used first.
+        """
+
+        loaded = self._loaded()
+        with self._lock:
+            return list(loaded)
+
+    def _loaded(self) -> OrderedDict:
+        if not hasattr(self._local, "models"):
+            self._local.models = OrderedDict()
+            with self._lock:
+                # A reused thread ID belongs to a finished thread, whose models go
+                self._threads[threading.get_ident()] = self._local.models
+
+        return self._local.models
+
+    def _load(self, info: ModelInfo):
+        model = cv2.dnn_superres.DnnSuperResImpl_create()
+        model.readModel(info.path)
+        model.setModel(info.algorithm, info.scale)
+
+        # Warm-up inference, the first forward pass initialises the network
+        model.upsample(np.zeros((32, 32, 3), dtype=np.uint8))
+
+        return model
+
+
+class _DepthToSpaceLayer:
+    """
+    Batch aware replacement for the `DepthToSpace` layer registered by
+    `cv2.dnn_superres`, which only rearranges the first image of a batch.
+    Uses the same channel layout as OpenCV's layer.
+    """
+
+    def __init__(self, params, blobs):
+        pass
+
+    @staticmethod
+    def _dims(channels: int):
+        # One output channel for the Y-only models, three otherwise (as OpenCV infers it)
+        out_channels = 1 if channels in (4, 9, 16) else 3
+        return out_channels, int(round((channels / out_channels) ** 0.5))
+
+    def getMemoryShapes(self, inputs):
+        batch, channels, height, width = inputs[0]
+        out_channels, scale = self._dims(channels)
+        return [[batch, out_channels, height * scale, width * scale]]
+
+    def forward(self, inputs):
+        features = inputs[0]
+        batch, channels, height, width = features.shape
+        out_channels, scale = self._dims(channels)
+
+        output = features.reshape(batch, scale, scale, out_channels, height, width)
+        output = output.transpose(0, 3, 4, 1, 5, 2)
+
+        return [output.reshape(batch, out_channels, height * scale, width * scale)]
+
+
+_layer_lock = threading.Lock()
+_layer_registered = False
+
+
+def _register_depth_to_space():
+    global _layer_registered
+
+    with _layer_lock:
+        if not _layer_registered:
+            # Creating an instance registers OpenCV's layer, ours is then stacked on top
+            cv2.dnn_superres.DnnSuperResImpl_create()
+            cv2.dnn_registerLayer("DepthToSpace", _DepthToSpaceLayer)
+            _layer_registered = True
+
+
+class SuperResBatcher:
+    """
+    Micro-batching scheduler for the super-resolution stage.
+
+    Requests are queued to a single scheduler thread, which waits up to `max_wait`
+    seconds after the first request for up to `batch_size` images of the same model
+    and shape, then runs them through the network as one blob. The colour conversion
+    around the network is done by the calling threads, matching `DnnSuperResImpl`:
+    only the Y channel is upscaled by the model, Cr and Cb are resized bilinearly.
+    Results are within 3 grey levels of `DnnSuperResImpl.upsample`.
+
+    Args:
+        models (dict): Available models by name, see `find_models`.
+        batch_size (int): Maximum number of images per forward pass. Defaults to
+            `SUPER_RES_BATCH_SIZE`.
+        max_wait (float): Seconds to wait for a batch to fill. Defaults to
+            `SUPER_RES_BATCH_WAIT_MS`.
+    """
+
+    def __init__(self, models: dict[str, ModelInfo] = None, batch_size: int = None, max_wait: float = None):
+        self.models = AVAILABLE_MODELS if models is None else models
+        self.batch_size = SUPER_RES_BATCH_SIZE if batch_size is None else batch_size
+        self.max_wait = SUPER_RES_BATCH_WAIT_MS / 1000 if max_wait is None else max_wait
+
+        self._nets = {}
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.batch_size > 1
+
+    def upsample(self, image: np.ndarray, name: str = DEFAULT_MODEL) -> tuple[np.ndarray, int]:
+        """
+        Upscale a BGR uint8 image, blocking until its batch has run.
+
+        Returns:
+            tuple: The upscaled image and the size of the batch it ran in.
+
+        Raises:
+            ValueError: If the model is not available.
+        """
+
+        if name not in self.models:
+            raise ValueError(f"Unknown super-resolution model '{name}', expected one of {list(self.models)}")
+
+        scale = self.models[name].scale
+        ycrcb = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb)
+        ycrcb = ycrcb.astype(np.float32)
+        cv2.multiply(ycrcb, 1 / 255, dst=ycrcb)
+        lum, cr, cb = cv2.split(ycrcb)
+
+        lum, batch = self.submit(lum, name).result()
+
+        cr = cv2.resize(cr, None, fx=scale, fy=scale)
+        cb = cv2.resize(cb, None, fx=scale, fy=scale)
+        merged = cv2.merge([lum, cr, cb])
+        # Saturate rather than take the absolute value, slightly negative outputs are black
+        merged = np.rint(np.clip(merged * 255, 0, 255)).astype(np.uint8)
+
+        return cv2.cvtColor(merged, cv2.COLOR_YCrCb2BGR), batch
+
+    def submit(self, lum: np.ndarray, name: str) -> Future:
+        """
+        Queue a normalised float32 Y channel for the scheduler.
+
+        Returns:
+            Future: Resolves to the upscaled Y channel and the batch size.
+        """
+
+        self._start()
+
+        future = Future()
+        self._queue.put((name, lum, future))
+
+        return future
+
+    def preload(self, names: list[str] = None):
+        """
+        Load and warm up models on the scheduler thread.
+        """
+
+        for name in PRELOAD_MODELS if names is None else names:
+            self.upsample(np.zeros((32, 32, 3), dtype=np.uint8), name)
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                _register_depth_to_space()
+                self._thread = threading.Thread(target=self._schedule, name="super-res-batcher", daemon=True)
+                self._thread.start()
+
+    def _schedule(self):
+        # Requests taken off the queue that did not fit the previous batch
+        pending = deque()
+
+        while True:
+            first = pending.popleft() if pending else self._queue.get()
+            key = (first[0], first[1].shape)
+            batch = [first]
+
+            # Same model and shape requests already waiting join the batch first
+            for request in list(pending):
+                if len(batch) == self.batch_size:
+                    break
+                if (request[0], request[1].shape) == key:
+                    pending.remove(request)
+                    batch.append(request)
+
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+                if (request[0], request[1].shape) == key:
+                    batch.append(request)
+                else:
+                    pending.append(request)
+
+            self._run(batch)
+
+    def _run(self, batch: list):
+        futures = [future for _, _, future in batch]
+
+        try:
+            net = self._net(batch[0][0])
+            net.setInput(cv2.dnn.blobFromImages([lum for _, lum, _ in batch]))
+            output = net.forward()
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for index, future in enumerate(futures):
+            future.set_result((output[index, 0], len(batch)))
+
+    def _net(self, name: str):
+        net = self._nets.get(name)
+        if net is None:
+            net = cv2.dnn.readNetFromTensorflow(self.models[name].path)
+            self._nets[name] = net
+
+        return net
@@ -0,0 +1,119 @@
+"""
+COPYRIGHT: University of Sunshine Coast 2024
+
+AUTHOR: Joseph Thurlow <joseph.thurlow@protonmail.com>
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PipelineCache:
+    """
+    Memory budgeted LRU cache of the intermediate images produced by `processImg`.
+
+    An intermediate is keyed by the upload and the ordered stages (with their
+    settings) applied so far, so a configuration that only changes later stages
+    resumes from the longest prefix it shares with an earlier run. Each entry also
+    keeps the `ProcessingContext` state the remaining stages depend on, e.g. the
+    sharpness measured by `laplacian_variance`.
+
+    Args:
+        max_bytes (int): Memory budget for the cached images.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def prefix_keys(img_bytes, img_type: str, stages: list) -> list[str]:
+        """
+        Keys for every prefix of a pipeline, chained so that each key covers the
+        upload and all the stages before it.
+
+        Args:
+            img_bytes: The upload, any object supporting the buffer protocol.
+            img_type (str): The upload's MIME type.
+            stages (list): `(name, settings)` pairs in pipeline order.
+
+        Returns:
+            list: One key per stage, the key at `i` identifies the image after stage `i`.
+        """
+
+        digest = hashlib.sha256(img_bytes)
+        digest.update(img_type.encode())
+
+        keys = []
+        for name, settings in stages:
+            digest.update(json.dumps([name, settings], sort_keys=True).encode())
+            keys.append(digest.copy().hexdigest())
+
+        return keys
+
+    def lookup(self, keys: list[str]):
+        """
+        Find the longest cached prefix.
+
+        Returns:
+            tuple: The number of stages covered and a writable copy of the cached
+            `(image, state)`, or `(0, None)` when nothing is cached.
+        """
+
+        with self._lock:
+            for index in range(len(keys) - 1, -1, -1):
+                entry = self._entries.get(keys[index])
+                if entry is not None:
+                    self._entries.move_to_end(keys[index])
+                    image, state = entry
+                    break
+            else:
+                return 0, None
+
+        return index + 1, (image.copy(), dict(state))
+
+    def put(self, key: str, image: np.ndarray, state: dict):
+        """
+        Store a copy of an intermediate image. Images larger than the whole budget
+        are not kept.
+        """
+
+        if image.nbytes > self.max_bytes:
+            return
+
+        image = image.copy()
+        image.flags.writeable = False
+
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[0].nbytes
+
+            self._entries[key] = (image, dict(state))
+            self.size += image.nbytes
+
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.size -= evicted.nbytes
+
+
+def create_pipeline_cache() -> PipelineCache:
+    """
+    Create the intermediate cache configured by `PIPELINE_CACHE_MB` (default 256,
+    0 disables the cache). The budget applies to each `ImageEnhancer`, i.e. to each
+    worker process with the process backend.
+
+    Returns:
+        PipelineCache: The cache, or None when disabled.
+    """
+
+    max_bytes = int(float(os.environ.get("PIPELINE_CACHE_MB", 256)) * 1024 * 1024)
+
+    return PipelineCache(max_bytes) if max_bytes > 0 else None
@@ -0,0 +1,164 @@
+"""
+COPYRIGHT: University of Sunshine Coast 2024
+
+AUTHOR: Joseph Thurlow <joseph.thurlow@protonmail.com>
+"""
+
+import threading
+
+
+class StageCostModel:
+    """
+    Per-stage cost model learned from the timings `time_enhancement` reports.
+
+    For every stage and settings combination it keeps an exponential moving average
+    of the seconds per megapixel of input and of the ratio of output to input
+    pixels (e.g. 4 for a x2 super-resolution model), so the cost of later stages
+    can be estimated from the size of the image they will receive.
+
+    Args:
+        smoothing (float): Weight of the newest observation in the averages.
+    """
+
+    def __init__(self, smoothing: float = 0.3):
+        self.smoothing = smoothing
+        self._costs = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, settings: tuple, in_pixels: int, out_pixels: int, seconds: float):
+        if in_pixels <= 0:
+            return
+
+        key = (name, settings)
+        per_megapixel = seconds / (in_pixels / 1e6)
+        scale = out_pixels / in_pixels
+
+        with self._lock:
+            previous = self._costs.get(key)
+            if previous is not None:
+                per_megapixel += (1 - self.smoothing) * (previous[0] - per_megapixel)
+                scale += (1 - self.smoothing) * (previous[1] - scale)
+
+            self._costs[key] = (per_megapixel, scale)
+
+    def estimate(self, name: str, settings: tuple):
+        """
+        Returns:
+            tuple: Seconds per megapixel and pixel scale, or None if the stage has not
+            been observed with these settings.
+        """
+
+        with self._lock:
+            return self._costs.get((name, settings))
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            return [
+                {"stage": name, "settings": dict(settings), "seconds_per_megapixel": cost, "pixel_scale": scale}
+                for (name, settings), (cost, scale) in self._costs.items()
+            ]
+
+
+class DeadlinePlanner:
+    """
+    Fits a plan spec into a time budget by degrading stages.
+
+    Stages declare their degradations with `@enhancement_degradation` as
+    `(overrides, cost_factor)` steps, cheapest last, where `overrides` are settings
+    replacing the configured ones (None skips the stage) and `cost_factor` is the
+    expected cost relative to the undegraded stage, used until the degraded
+    variant has been observed. While the estimated total exceeds the budget the
+    planner greedily takes the next step that saves the most time, accounting for
+    the smaller images later stages receive when e.g. an upscale is skipped.
+
+    Args:
+        cost_model (StageCostModel): The learned stage costs.
+    """
+
+    def __init__(self, cost_model: StageCostModel):
+        self.cost_model = cost_model
+
+    def fit(self, spec: tuple, degradations: dict, pixels: int, budget: float, encoding: tuple = ()):
+        """
+        Args:
+            spec (tuple): The plan spec, `(name, settings)` pairs in pipeline order.
+            degradations (dict): Degradation steps by stage name.
+            pixels (int): Pixel count of the decoded image.
+            budget (float): Seconds available for the stages and encoding.
+            encoding (tuple): The plan's output encoder settings.
+
+        Returns:
+            tuple: The degraded spec, the list of degradations applied and the
+            estimated seconds of the returned spec.
+        """
+
+        steps = [-1] * len(spec)
+        estimate = self._estimate(spec, degradations, steps, pixels, encoding)
+
+        while estimate > budget:
+            best = None
+            for index, (name, _) in enumerate(spec):
+                if steps[index] + 1 >= len(degradations.get(name, ())):
+                    continue
+
+                candidate = list(steps)
+                candidate[index] += 1
+                candidate_estimate = self._estimate(spec, degradations, candidate, pixels, encoding)
+
+                if candidate_estimate < estimate and (best is None or candidate_estimate < best[1]):
+                    best = (candidate, candidate_estimate)
+
+            if best is None:
+                break
+
+            steps, estimate = best
+
+        degraded_spec = []
+        degraded = []
+        for (name, settings), step in zip(spec, steps):
+            if step < 0:
+                degraded_spec.append((name, settings))
+                continue
+
+            overrides, _ = degradations[name][step]
+            if overrides is None:
+                degraded.append({"stage": name, "skipped": True})
+                continue
+
+            degraded_spec.append((name, self._override(settings, overrides)))
+            degraded.append({"stage": name, "settings": overrides})
+
+        return tuple(degraded_spec), degraded, estimate
+
+    def _estimate(self, spec: tuple, degradations: dict, steps: list, pixels: int, encoding: tuple) -> float:
+        total = 0
+        for (name, settings), step in zip(spec, steps):
+            base = self.cost_model.estimate(name, settings)
+
+            if step >= 0:
+                overrides, cost_factor = degradations[name][step]
+                if overrides is None:
+                    continue
+
+                observed = self.cost_model.estimate(name, self._override(settings, overrides))
+                if observed is None and base is not None:
+                    observed = (base[0] * cost_factor, base[1])
+                base = observed
+
+            # Stages never observed are assumed free until their first run
+            if base is None:
+                continue
+
+            per_megapixel, scale = base
+            total += per_megapixel * pixels / 1e6
+            pixels *= scale
+
+        return total + self._encodeEstimate(pixels, encoding)
+
+    def _encodeEstimate(self, pixels: float, encoding: tuple) -> float:
+        encode = self.cost_model.estimate("encode", encoding)
+        return encode[0] * pixels / 1e6 if encode is not None else 0
+
+    @staticmethod
+    def _override(settings: tuple, overrides: dict) -> tuple:
+        return tuple(sorted({**dict(settings), **overrides}.items()))
@@ -1,24 +1,332 @@
+import hashlib
+import json
+import math
 import os
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import timedelta
-from functools import wraps
+from functools import lru_cache, wraps
+from typing import Callable, NamedTuple
 
 import cv2
 import numpy as np
 from numpy import uint8
-from skimage import exposure, img_as_float, img_as_ubyte
-from skimage.restoration import richardson_lucy
+from skimage import exposure
 
-current_dir = os.path.dirname(os.path.abspath(__file__))
-model_path = os.path.join(current_dir, "static/models/ESPCN_x2.pb")
-
-super_res_model = cv2.dnn_superres.DnnSuperResImpl_create()
-super_res_model.readModel(model_path)
-super_res_model.setModel("espcn", 2)
+from seaserver.deconvolution import RichardsonLucyEngine
+from seaserver.image_probe import probe_dimensions
+from seaserver.models import AVAILABLE_MODELS, DEFAULT_MODEL, SuperResBatcher, SuperResModelManager
+from seaserver.pipeline_cache import create_pipeline_cache
+from seaserver.planning import DeadlinePlanner, StageCostModel
 
 enhancement_registry = []
+settings_registry = []
+
+# Row/column stride of the sample used for the white balance channel means
+WB_SUBSAMPLE = 4
+
+# Relative change between Richardson-Lucy iterations below which the adaptive mode stops
+RL_CONVERGENCE_THRESHOLD = 5e-3
+
+# Normalised clip limit of adaptive histogram equalisation (skimage convention)
+CLAHE_CLIP_LIMIT = 0.01
+CLAHE_GRID = (8, 8)
+
+# Images with more pixels than this are processed in tiles of TILE_SIZE x TILE_SIZE
+TILE_MIN_PIXELS = 4_000_000
+TILE_SIZE = 1024
+TILE_WORKERS = int(os.environ.get("TILE_WORKERS", os.cpu_count() or 1))
+
+_tile_executor: ThreadPoolExecutor = None
+
+# Longest side of the downscaled proxy returned by Frame.proxy
+PROXY_MAX_SIDE = 512
+
+# Latency budget of a progressive preview, which runs on the proxy
+PREVIEW_BUDGET_MS = float(os.environ.get("PREVIEW_BUDGET_MS", 200))
+
+# Number of compiled enhancement plans kept
+PLAN_CACHE_SIZE = 64
+
+# Bytes of idle scratch arrays kept by the buffer pool
+BUFFER_POOL_BYTES = int(float(os.environ.get("BUFFER_POOL_MB", 256)) * 1024 * 1024)
+
+# Uploads with more pixels than this are rejected before being decoded
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 100_000_000))
+
+ENCODE_MAP = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp", "image/tiff": ".tiff"}
+
+# Output encoder settings, negotiated per session or per job. Sent from `/options`
+# alongside the enhancement settings.
+OUTPUT_SETTINGS = [
+    {
+        "name": "output_format",
+        "lbl": "Output Format",
+        "tt": "The format the result is encoded in. Source keeps the format of the upload.",
+        "choices": ["source", *ENCODE_MAP],
+        "default": "source",
+    },
+    {
+        "name": "output_quality",
+        "lbl": "Output Quality",
+        "tt": "JPEG and WebP quality from 1 to 100. Lower values trade detail for smaller results.",
+        "choices": [100, 95, 90, 80, 70, 50],
+        "default": 95,
+    },
+    {
+        "name": "jpeg_progressive",
+        "lbl": "Progressive JPEG",
+        "tt": "Encode JPEGs progressively, so a partial download already shows the whole image.",
+        "choices": [False, True],
+        "default": False,
+    },
+    {
+        "name": "png_compression",
+        "lbl": "PNG Compression",
+        "tt": "PNG compression level from 0 to 9. Higher levels are smaller but slower to encode.",
+        "choices": list(range(10)),
+        "default": 1,
+    },
+]
+settings_registry.extend(OUTPUT_SETTINGS)
+
+# JPEG DCT domain downscaling factors, largest first
+JPEG_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+class BufferPool:
+    """
+    Shape and dtype keyed pool of scratch arrays for the enhancement hot loop.
+
+    Stages borrow arrays instead of allocating full-size temporaries on every call
+    and return them when done, so under sustained load the same memory is reused
+    rather than churned through the allocator. Borrowed arrays are uninitialised.
+    Idle arrays are kept up to `max_bytes`, arrays returned past that are freed.
+
+    Args:
+        max_bytes (int): Budget for idle arrays.
+    """
+
+    def __init__(self, max_bytes: int = BUFFER_POOL_BYTES):
+        self.max_bytes = max_bytes
+
+        self._free = defaultdict(list)
+        self._in_use = defaultdict(int)
+        self._high_water = defaultdict(int)
+        self._free_bytes = 0
+        self._in_use_bytes = 0
+        self._high_water_bytes = 0
+        self._allocations = 0
+        self._reuses = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, shape: tuple, dtype=np.float32) -> np.ndarray:
+        key = (tuple(shape), np.dtype(dtype).name)
+
+        with self._lock:
+            free = self._free[key]
+            array = free.pop() if free else None
+
+            if array is None:
+                self._allocations += 1
+            else:
+                self._reuses += 1
+                self._free_bytes -= array.nbytes
+
+            self._in_use[key] += 1
+            self._high_water[key] = max(self._high_water[key], self._in_use[key])
+
+        if array is None:
+            array = np.empty(shape, dtype=dtype)
+
+        with self._lock:
+            self._in_use_bytes += array.nbytes
+            self._high_water_bytes = max(self._high_water_bytes, self._in_use_bytes)
+
+        return array
+
+    def release(self, array: np.ndarray):
+        key = (array.shape, array.dtype.name)
+
+        with self._lock:
+            self._in_use[key] -= 1
+            self._in_use_bytes -= array.nbytes
+
+            if self._free_bytes + array.nbytes <= self.max_bytes:
+                self._free[key].append(array)
+                self._free_bytes += array.nbytes
+
+    @contextmanager
+    def borrow(self, shape: tuple, dtype=np.float32):
+        """
+        Context manager lending an array for the duration of the block.
+        """
+
+        array = self.acquire(shape, dtype)
+        try:
+            yield array
+        finally:
+            self.release(array)
+
+    def stats(self) -> dict:
+        """
+        Pool metrics. High-water marks are the most arrays (per shape) and bytes
+        borrowed at once since start-up.
+        """
+
+        with self._lock:
+            return {
+                "in_use_bytes": self._in_use_bytes,
+                "free_bytes": self._free_bytes,
+                "high_water_bytes": self._high_water_bytes,
+                "allocations": self._allocations,
+                "reuses": self._reuses,
+                "buffers": [
+                    {
+                        "shape": list(shape),
+                        "dtype": dtype,
+                        "in_use": self._in_use[(shape, dtype)],
+                        "free": len(self._free[(shape, dtype)]),
+                        "high_water": high_water,
+                    }
+                    for (shape, dtype), high_water in self._high_water.items()
+                ],
+            }
+
+
+buffer_pool = BufferPool()
+
+
+def should_tile(image: np.ndarray) -> bool:
+    return image.shape[0] * image.shape[1] > TILE_MIN_PIXELS
+
+
+def tile_bounds(height: int, width: int, tile_size: int = TILE_SIZE):
+    """
+    Split an image into a grid of non-overlapping `(y0, y1, x0, x1)` tile regions.
+    """
+
+    return [
+        (y0, min(y0 + tile_size, height), x0, min(x0 + tile_size, width))
+        for y0 in range(0, height, tile_size)
+        for x0 in range(0, width, tile_size)
+    ]
+
+
+def tile_shape(image: np.ndarray, bounds: tuple, halo: int) -> tuple:
+    y0, y1, x0, x1 = bounds
+    return (y1 - y0 + 2 * halo, x1 - x0 + 2 * halo) + image.shape[2:]
+
+
+def extract_tile(image: np.ndarray, bounds: tuple, halo: int, out: np.ndarray = None) -> np.ndarray:
+    """
+    Copy a tile region plus `halo` pixels on every side. Neighbouring pixels are used
+    for the halo where they exist, the image is reflected past its borders.
+
+    Args:
+        out (ndarray): Array of `tile_shape` to copy the tile into, allocated if None.
+    """
+
+    height, width = image.shape[:2]
+    y0, y1, x0, x1 = bounds
+
+    top, bottom = max(y0 - halo, 0), min(y1 + halo, height)
+    left, right = max(x0 - halo, 0), min(x1 + halo, width)
+
+    return cv2.copyMakeBorder(
+        image[top:bottom, left:right],
+        halo - (y0 - top),
+        halo - (bottom - y1),
+        halo - (x0 - left),
+        halo - (right - x1),
+        cv2.BORDER_REFLECT_101,
+        dst=out,
+    )
+
+
+def process_tiled(image: np.ndarray, tile_func, halo: int, tile_size: int = TILE_SIZE, bounds: list = None) -> np.ndarray:
+    """
+    Apply a shape preserving function to an image tile by tile across the tile
+    worker pool and stitch the results.
+
+    Args:
+        image (ndarray): The image to process.
+        tile_func (function): Called with each haloed tile and a pooled array of
+            the same shape and dtype to write its result into (`out`), must return
+            the result.
+        halo (int): Overlap on each side of a tile. Must cover the function's
+            support (e.g. the PSF radius times the number of passes) for the
+            stitched result to be seamless.
+        tile_size (int): Side length of the tile core.
+        bounds (list): Tile regions to process, defaults to the full grid.
+
+    Returns:
+        ndarray: The stitched result. Working memory is bounded by the tile size
+        and the number of tile workers rather than the image size.
+    """
+
+    global _tile_executor
+    if _tile_executor is None:
+        _tile_executor = ThreadPoolExecutor(max_workers=TILE_WORKERS)
+
+    output = np.empty_like(image)
+
+    def run(tile_region):
+        y0, y1, x0, x1 = tile_region
+        shape = tile_shape(image, tile_region, halo)
+
+        with buffer_pool.borrow(shape, image.dtype) as tile, buffer_pool.borrow(shape, image.dtype) as tile_out:
+            result = tile_func(extract_tile(image, tile_region, halo, out=tile), tile_out)
+            output[y0:y1, x0:x1] = result[halo:halo + y1 - y0, halo:halo + x1 - x0]
+
+    if bounds is None:
+        bounds = tile_bounds(*image.shape[:2], tile_size)
+
+    for _ in _tile_executor.map(run, bounds):
+        pass
+
+    return output
+
+
+def rl_halo(point_spread_func: np.ndarray, iterations: int) -> int:
+    """
+    Tile halo needed for Richardson-Lucy deconvolution to be seamless.
+
+    Every iteration convolves with the PSF twice, so the exact support grows by the
+    PSF size each iteration. Repeated blurs quickly approach a Gaussian though, so
+    the halo is 4 standard deviations of the combined blur, capped at the exact support.
+    """
+
+    kernel_h, kernel_w = point_spread_func.shape
+    weights = point_spread_func / point_spread_func.sum()
+    rows, cols = np.indices(point_spread_func.shape)
+
+    variance = max(
+        (weights * (rows - (kernel_h - 1) / 2) ** 2).sum(),
+        (weights * (cols - (kernel_w - 1) / 2) ** 2).sum(),
+    )
+
+    exact = iterations * (max(kernel_h, kernel_w) - 1)
+    return int(min(exact, math.ceil(4 * math.sqrt(2 * iterations * variance))))
+
+
+def create_clahe(clip_limit: float = CLAHE_CLIP_LIMIT):
+    """
+    Create an OpenCV CLAHE equivalent to skimage's `equalize_adapthist`.
+
+    skimage clips each of its 256 histogram bins at `clip_limit * tile_area` while
+    OpenCV clips at `clipLimit * tile_area / 256`, so the limit is scaled by 256.
+    skimage's default kernel is 1/8 of the image, i.e. an 8x8 tile grid.
+    """
+
+    return cv2.createCLAHE(clipLimit=clip_limit * 256, tileGridSize=CLAHE_GRID)
 
-ENCODE_MAP = {"image/jpeg": ".jpg", "image/png": ".png"}
 
 def save_encoded_image(img_encoded, filename="output_image.jpg"):
     # Decode the image
@@ -29,27 +337,281 @@ def save_encoded_image(img_encoded, filename="output_image.jpg"):
     print(f"Image saved as {filename}")
 
 
-def encode_img(img_arr, img_format: str):
+def parse_flag(value) -> bool:
+    """
+    Parse a boolean setting given as a JSON boolean or a `"true"`/`"false"` form value.
+
+    Raises:
+        ValueError: If the value is neither.
+    """
+
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+
+    raise ValueError(f"Expected true or false, got {value!r}")
+
+
+def _parse_int(name: str, value) -> int:
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{name} must be an integer")
+
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer")
+
+
+def output_settings(config: dict) -> dict:
+    """
+    The output encoder settings of a configuration, falling back to the defaults.
+
+    Raises:
+        ValueError: If a setting is malformed or out of range.
+    """
+
+    settings = {
+        setting["name"]: config.get(setting["name"], setting["default"])
+        for setting in OUTPUT_SETTINGS
+    }
+
+    if not isinstance(settings["output_format"], str) or (
+        settings["output_format"] != "source" and settings["output_format"] not in ENCODE_MAP
+    ):
+        raise ValueError(f"Unsupported output format '{settings['output_format']}'")
+
+    settings["output_quality"] = _parse_int("output_quality", settings["output_quality"])
+    if not 1 <= settings["output_quality"] <= 100:
+        raise ValueError("output_quality must be between 1 and 100")
+
+    settings["png_compression"] = _parse_int("png_compression", settings["png_compression"])
+    if not 0 <= settings["png_compression"] <= 9:
+        raise ValueError("png_compression must be between 0 and 9")
+
+    try:
+        settings["jpeg_progressive"] = parse_flag(settings["jpeg_progressive"])
+    except ValueError:
+        raise ValueError("jpeg_progressive must be true or false")
+
+    return settings
+
+
+def validate_config(config) -> dict:
+    """
+    Check a configuration before it is stored in the session. Enhancement
+    settings must be one of their `choices`, and output settings within range.
+
+    Returns:
+        dict: The configuration, unchanged.
+
+    Raises:
+        ValueError: If the configuration or a setting is invalid.
+    """
+
+    if not isinstance(config, dict):
+        raise ValueError("Configuration must be an object")
+
+    for setting in settings_registry:
+        if setting in OUTPUT_SETTINGS or setting["name"] not in config:
+            continue
+
+        value = config[setting["name"]]
+        if isinstance(value, (list, dict)) or value not in setting["choices"]:
+            raise ValueError(f"Unsupported {setting['name']} {value!r}, expected one of {setting['choices']}")
+
+    output_settings(config)
+
+    return config
+
+
+def output_format(encoding: dict, img_format: str) -> str:
+    """
+    The MIME type a result is encoded in, given its output settings and the
+    upload's MIME type.
+    """
+
+    return img_format if encoding.get("output_format", "source") == "source" else encoding["output_format"]
+
+
+def encode_img(img_arr, img_format: str, encoding: dict = None):
+    """
+    Encode an image.
+
+    Args:
+        img_arr (ndarray): The BGR uint8 image.
+        img_format (str): The MIME type to encode in.
+        encoding (dict): Output settings (see `output_settings`), OpenCV's
+            defaults are used for settings that are missing.
+
+    Returns:
+        ndarray: The encoded bytes, or None if the format is unsupported.
+    """
+
     format = ENCODE_MAP.get(img_format)
 
     if not format:
         return None
-    
-    _, img_encoded = cv2.imencode(format, img_arr)
+
+    encoding = encoding or {}
+    params = []
+    if format == ".jpg":
+        params += [cv2.IMWRITE_JPEG_QUALITY, encoding.get("output_quality", 95)]
+        params += [cv2.IMWRITE_JPEG_PROGRESSIVE, int(encoding.get("jpeg_progressive", False))]
+    elif format == ".webp":
+        params += [cv2.IMWRITE_WEBP_QUALITY, encoding.get("output_quality", 100)]
+    elif format == ".png":
+        params += [cv2.IMWRITE_PNG_COMPRESSION, encoding.get("png_compression", 1)]
+
+    _, img_encoded = cv2.imencode(format, img_arr, params)
 
     return img_encoded
 
 
-def decode_img(img_bytes: bytes, img_format: str):
+def decode_img(img_bytes: bytes, img_format: str, max_side: int = None):
     """
-    Decode image bytes to numpy array
+    Decode image bytes to a BGR uint8 numpy array. JPEG, PNG, WebP and TIFF are
+    supported, alpha is dropped and 16 bit images are scaled to 8 bit.
+
+    Args:
+        img_bytes: The encoded image.
+        img_format (str): The image's MIME type.
+        max_side (int): Longest side the caller is going to downscale the image to.
+            JPEGs are then decoded at the largest DCT domain reduction (1/2, 1/4
+            or 1/8) that still covers it, skipping most of the decoding work.
+
+    Returns:
+        ndarray: The decoded image, or None if the format is unsupported or the
+        image could not be decoded.
     """
 
-    if img_format == "image/jpeg":
-        return cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
-    else:
+    if img_format not in ENCODE_MAP:
         return None
 
+    flags = cv2.IMREAD_COLOR
+    if max_side is not None and img_format == "image/jpeg":
+        size = probe_dimensions(img_bytes, img_format)
+        if size is not None:
+            for factor, reduced_flags in JPEG_REDUCED_FLAGS:
+                if max(size) // factor >= max_side:
+                    flags = reduced_flags
+                    break
+
+    return cv2.imdecode(np.frombuffer(img_bytes, np.uint8), flags)
+
+
+def convert_image(image: np.ndarray, dtype) -> np.ndarray:
+    """
+    Convert an image between the pipeline's working representations. uint8 images
+    span 0-255, float32 images span 0-1. Images already of `dtype` are returned as is.
+    """
+
+    if image.dtype == dtype:
+        return image
+
+    if dtype == np.float32:
+        float_img = image.astype(np.float32)
+        float_img *= 1 / 255
+        return float_img
+
+    if dtype == np.uint8:
+        scaled_img = np.multiply(image, 255, dtype=np.float32)
+        np.rint(scaled_img, out=scaled_img)
+        np.clip(scaled_img, 0, 255, out=scaled_img)
+        return scaled_img.astype(np.uint8)
+
+    raise ValueError(f"Unsupported working dtype {dtype}")
+
+
+class Frame:
+    """
+    The image travelling through the pipeline together with lazily computed,
+    cached views of it (working dtypes, grayscale, LAB and a downscaled proxy).
+
+    Views are computed at most once per version of the image and are read-only.
+    `update` replaces the pixels and drops every view, so an enhancement that
+    changes the image must return it (even when modified in place) rather than None.
+
+    Args:
+        image (ndarray): The decoded BGR image.
+    """
+
+    def __init__(self, image: np.ndarray):
+        self.image = image
+        self.version = 0
+        self._views = {}
+
+    def update(self, image: np.ndarray):
+        self.image = image
+        self.version += 1
+        self._views.clear()
+
+    def view(self, dtype) -> np.ndarray:
+        """
+        The image in one of the working dtypes, see `convert_image`.
+        """
+
+        if self.image.dtype == dtype:
+            return self.image
+
+        return self._cached(np.dtype(dtype).name, lambda: convert_image(self.image, dtype))
+
+    def gray(self) -> np.ndarray:
+        return self._cached("gray", lambda: cv2.cvtColor(self.view(np.uint8), cv2.COLOR_BGR2GRAY))
+
+    def lab(self) -> np.ndarray:
+        return self._cached("lab", lambda: cv2.cvtColor(self.view(np.uint8), cv2.COLOR_BGR2LAB))
+
+    def proxy(self, max_side: int = PROXY_MAX_SIDE) -> np.ndarray:
+        """
+        A uint8 copy of the image downscaled so its longest side is at most
+        `max_side`, for estimates that don't need every pixel.
+        """
+
+        def downscale():
+            image = self.view(np.uint8)
+            scale = max_side / max(image.shape[:2])
+            if scale >= 1:
+                return image
+            return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        return self._cached(("proxy", max_side), downscale)
+
+    def _cached(self, key, compute) -> np.ndarray:
+        view = self._views.get(key)
+        if view is None:
+            view = compute()
+            if view is not self.image:
+                view.flags.writeable = False
+            self._views[key] = view
+
+        return view
+
+
+def white_balance_lut(channel_avg: float, strength: float = 0.8):
+    """
+    Build the lookup table for the white balance shift of one LAB colour channel.
+
+    The shift for a pixel is `(channel_avg - 128) * (L / 255) * strength`. Entry `L`
+    of the table holds its magnitude rounded so that adding or subtracting it matches
+    truncating the float result, as the original float64 implementation did.
+
+    Args:
+        channel_avg (float): Mean of the a or b channel.
+        strength (float): Fraction of the cast that is removed.
+
+    Returns:
+        tuple: The uint8 lookup table and whether it should be subtracted (True)
+        or added (False).
+    """
+
+    shift = (channel_avg - 128) * (np.arange(256) / 255.0) * strength
+
+    if channel_avg >= 128:
+        return np.ceil(shift).astype(np.uint8), True
+
+    return np.floor(-shift).astype(np.uint8), False
+
 
 def bytes_to_ndarray(bytes: bytes):
     """
@@ -76,6 +638,10 @@ def enhancement_metadata(name, description):
     def decorator(func):
         func.filter_name = name
         func.filter_description = description
+        func.settings = []
+        func.degradations = []
+        func.accepts = getattr(func, "accepts", np.uint8)
+        func.produces = getattr(func, "produces", np.uint8)
         
         enhancement_registry.append(func)
         return func
@@ -83,6 +649,134 @@ def enhancement_metadata(name, description):
     return decorator
 
 
+def enhancement_setting(name, label, description, choices, default):
+    """
+    A decorator to register a setting for an image enhancement function.
+
+    Args:
+        name (str): The configuration key of the setting.
+        label (str): The display name of the setting.
+        description (str): A description of what the setting changes.
+        choices (list): The values the setting accepts.
+        default: The value used when the setting is missing from the configuration.
+
+    Returns:
+        function: The decorated function with the setting attached.
+
+    Must be applied above `@enhancement_metadata`. The setting is sent from the
+    `/options` endpoint and its configured value is passed to the enhancement
+    function as a keyword argument of the same name.
+    """
+
+    def decorator(func):
+        setting = {
+            "name": name,
+            "lbl": label,
+            "tt": description,
+            "choices": choices,
+            "default": default,
+        }
+
+        func.settings.insert(0, setting)
+        settings_registry.append(setting)
+        return func
+
+    return decorator
+
+
+def enhancement_degradation(*steps):
+    """
+    A decorator to declare cheaper variants of an enhancement that the deadline
+    planner may fall back to when a request would otherwise miss its deadline.
+
+    Args:
+        steps: `(overrides, cost_factor)` tuples, cheapest last. `overrides` is a
+            dict of keyword arguments replacing the configured settings, or None to
+            skip the enhancement. `cost_factor` is the expected cost relative to the
+            undegraded enhancement, used until the variant's cost has been measured.
+
+    Returns:
+        function: The decorated function with the degradations attached.
+
+    Must be applied above `@enhancement_metadata`. See `DeadlinePlanner`.
+    """
+
+    def decorator(func):
+        func.degradations = list(steps)
+        return func
+
+    return decorator
+
+
+@lru_cache(maxsize=1)
+def stage_degradations() -> dict:
+    return {func.__name__: func.degradations for func in enhancement_registry if func.degradations}
+
+
+def enhancement_dtype(accepts, produces=None):
+    """
+    A decorator to declare the working dtype an enhancement function accepts and
+    produces (`np.uint8` or `np.float32`). Enhancements default to uint8 in and out.
+
+    Args:
+        accepts: The dtype the function expects its input image in. May also be a
+            function of the enhancement's settings (passed as keyword arguments)
+            returning the dtype, for enhancements whose settings change it.
+        produces: The dtype of the returned image, defaults to `accepts`.
+
+    Returns:
+        function: The decorated function with the dtypes attached.
+
+    Must be applied below `@enhancement_metadata`. The image is only converted
+    between stages when the dtype produced by one differs from the dtype accepted
+    by the next.
+    """
+
+    def decorator(func):
+        func.accepts = accepts
+        func.produces = produces or accepts
+        return func
+
+    return decorator
+
+
+def resolve_dtype(dtype, settings: dict):
+    """
+    Resolve a dtype declared with `@enhancement_dtype` for the given settings.
+    """
+
+    return dtype(**settings) if callable(dtype) and not isinstance(dtype, type) else dtype
+
+
+def stage_settings(enhancement_func, config: dict) -> dict:
+    """
+    The settings an enhancement function runs with, taken from the configuration
+    and falling back to each setting's default.
+    """
+
+    return {
+        setting["name"]: config.get(setting["name"], setting["default"])
+        for setting in enhancement_func.settings
+    }
+
+
+def normalise_config(config: dict) -> list:
+    """
+    Reduce a configuration to what affects the output: the enabled enhancements in
+    pipeline order, each with its resolved settings. Configurations that run the
+    same pipeline normalise to the same value.
+
+    Returns:
+        list: `[name, settings]` pairs, JSON serialisable.
+    """
+
+    return [
+        [func.__name__, stage_settings(func, config)]
+        for func in enhancement_registry
+        if config.get(func.__name__)
+    ]
+
+
 def time_enhancement(func):
     """
     A decorator to measure and log the execution time of an enhancement function.
@@ -96,7 +790,9 @@ def time_enhancement(func):
     
     The wrapped function will print the time taken to execute and return a
     list where the first element is the function result and the second element
-    is a dictionary with the execution time in seconds.
+    is a dictionary with the execution time in seconds. A function may also
+    return a `(result, info)` tuple, in which case the `info` dictionary is
+    merged into the timing dictionary.
     """
      
     @wraps(func)
@@ -108,16 +804,155 @@ def time_enhancement(func):
 
         print(f"{func.__name__} took {elapsed_time} to run.")
 
-        formatted_result = [result, {func.__name__: elapsed_time.total_seconds()}]
+        info = {func.__name__: elapsed_time.total_seconds()}
+        if isinstance(result, tuple):
+            result, extra_info = result
+            info.update(extra_info)
+
+        formatted_result = [result, info]
 
         return formatted_result
 
+    wrapper.timed = True
+
     return wrapper
 
 
+class PlanStage(NamedTuple):
+    name: str
+    run: Callable
+    accepts: type
+
+
+class EnhancementPlan(NamedTuple):
+    """
+    An immutable execution plan compiled from a configuration by `compile_plan`.
+
+    Attributes:
+        key (str): Hash of the normalised configuration, equal for every
+            configuration that runs the same pipeline.
+        spec (tuple): `(name, settings)` pairs of the enabled enhancements in
+            pipeline order, settings as sorted `(name, value)` tuples.
+        encoding (tuple): The output encoder settings as sorted `(name, value)`
+            tuples, see `output_settings`.
+        stages (tuple): The `PlanStage`s to run. `run(enhancer, image, ctx)` calls the
+            enhancement with its settings bound and returns `(image, info)`, where
+            `image` is None if the stage leaves the image unchanged. `accepts` is
+            the resolved input dtype; consecutive stages with the same dtype share
+            the image array without conversion.
+    """
+
+    key: str
+    spec: tuple
+    encoding: tuple
+    stages: tuple
+
+    def __reduce__(self):
+        # Pickled as its spec, the receiving process compiles (and caches) its own
+        return plan_from_spec, (self.spec, self.encoding)
+
+
+def _bind_stage(enhancement_func, settings: dict) -> Callable:
+    if getattr(enhancement_func, "timed", False):
+        def run(enhancer, image, ctx):
+            result, info = enhancement_func(enhancer, image, ctx, **settings)
+            return result, info
+    else:
+        def run(enhancer, image, ctx):
+            return enhancement_func(enhancer, image, ctx, **settings), None
+
+    return run
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def plan_from_spec(spec: tuple, encoding: tuple = ()) -> EnhancementPlan:
+    """
+    Build the plan for a normalised spec and output encoding, see
+    `EnhancementPlan.spec` and `EnhancementPlan.encoding`.
+    """
+
+    registry = {func.__name__: func for func in enhancement_registry}
+
+    stages = []
+    for name, settings in spec:
+        enhancement_func = registry[name]
+        settings = dict(settings)
+        stages.append(PlanStage(
+            name,
+            _bind_stage(enhancement_func, settings),
+            resolve_dtype(enhancement_func.accepts, settings),
+        ))
+
+    key = hashlib.sha256(json.dumps([spec, encoding]).encode()).hexdigest()
+
+    return EnhancementPlan(key, spec, encoding, tuple(stages))
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _compile_config(config_json: str) -> EnhancementPlan:
+    config = json.loads(config_json)
+    spec = tuple(
+        (name, tuple(sorted(settings.items())))
+        for name, settings in normalise_config(config)
+    )
+    encoding = tuple(sorted(output_settings(config).items()))
+
+    return plan_from_spec(spec, encoding)
+
+
+def compile_plan(config) -> EnhancementPlan:
+    """
+    Compile a configuration into an execution plan. Plans are cached by the
+    configuration's contents, so repeated configurations are a dictionary lookup.
+
+    Args:
+        config (dict | EnhancementPlan): The session configuration, plans are
+            returned unchanged.
+
+    Returns:
+        EnhancementPlan: The immutable plan.
+
+    Raises:
+        ValueError: If the output settings are invalid.
+    """
+
+    if isinstance(config, EnhancementPlan):
+        return config
+
+    return _compile_config(json.dumps(config, sort_keys=True))
+
+
+class ProcessingContext:
+    """
+    Per-request state shared between the stages of one `processImg` call. Keeping
+    it out of the `ImageEnhancer` lets one enhancer run concurrent jobs.
+
+    Attributes:
+        sharpness (float): The Laplacian variance measured by `laplacian_variance`,
+            None if it has not been measured.
+        frame (Frame): The image being enhanced and its cached views.
+    """
+
+    def __init__(self, sharpness: float = None, frame: Frame = None):
+        self.sharpness = sharpness
+        self.frame = frame
+
+    def state(self) -> dict:
+        """
+        The context as keyword arguments for `ProcessingContext`, see `PipelineCache`.
+        """
+
+        return {"sharpness": self.sharpness}
+
+
 class ImageEnhancer:        
     def __init__(self):
-        self.sharpness:int = None
+        self.super_res_models = SuperResModelManager()
+        self.super_res_batcher = SuperResBatcher()
+        self.rl_engine = RichardsonLucyEngine(buffer_pool=buffer_pool)
+        self.pipeline_cache = create_pipeline_cache()
+        self.cost_model = StageCostModel()
+        self.planner = DeadlinePlanner(self.cost_model)
 
     def getAvailableEnhancements(self):
         available_filters = []
@@ -130,39 +965,171 @@ class ImageEnhancer:
 
         return available_filters
 
-    def processImg(self, img_bytes, img_type, config: dict):
-        print("Configuration", config)
-        self.sharpness = None
-        np_image = decode_img(img_bytes, img_type)
+    def getAvailableSettings(self):
+        return [dict(setting) for setting in settings_registry]
+
+    def processImg(
+        self,
+        img_bytes,
+        img_type,
+        config,
+        deadline: float = None,
+        preview: bool = False,
+        cancelled: Callable[[], bool] = None,
+    ):
+        """
+        Enhance an image.
+
+        Args:
+            img_bytes: The encoded upload.
+            img_type (str): The upload's MIME type, also the output format unless
+                the plan's `output_format` says otherwise.
+            config (dict | EnhancementPlan): The configuration or its compiled plan.
+            deadline (float): `time.time()` by which the result should be ready. The
+                plan is degraded to fit using the learned stage costs, and what was
+                degraded is listed under `degraded` in the durations.
+            preview (bool): Run on the downscaled proxy within `PREVIEW_BUDGET_MS`
+                instead, for a fast first result. Previews bypass the pipeline cache.
+            cancelled (Callable): Polled at every stage boundary. Once it returns True
+                the job is abandoned and reported under `cancelled` in the errors.
+
+        Returns:
+            tuple: The encoded image (None if decoding failed), the durations and
+            the errors by enhancement name.
+        """
 
-        if np_image is None:
-            return None
+        plan = compile_plan(config)
+        print("Configuration", plan.spec)
+        ctx = ProcessingContext()
+
+        # Also releases the models of workers that no longer get super-resolution jobs
+        self.super_res_models.evictIdle()
 
         duration = {}
         errors = {}
 
-        for enhancement_func in enhancement_registry:
-            if enhancement_func.__name__ not in config or not config[enhancement_func.__name__]:
-                continue
+        # The header gives the size to plan with before any pixels are allocated
+        size = probe_dimensions(img_bytes, img_type)
+        pixels = size[0] * size[1] if size is not None else None
+
+        if pixels is not None and pixels > MAX_IMAGE_PIXELS:
+            errors["decode"] = f"Image of {size[0]}x{size[1]} exceeds {MAX_IMAGE_PIXELS} pixels"
+            return None, duration, errors
+
+        np_image = None
+        if preview:
+            deadline = time.time() + PREVIEW_BUDGET_MS / 1000
+            np_image = decode_img(img_bytes, img_type, PROXY_MAX_SIDE)
+            if np_image is not None:
+                np_image = Frame(np_image).proxy().copy()
+                pixels = np_image.shape[0] * np_image.shape[1]
+                duration["preview"] = True
+
+        # Resume from the longest run of leading stages already computed for this upload
+        cache_keys = None
+        resumed = 0
+        if self.pipeline_cache is not None and plan.stages and not preview:
+            cache_keys = self.pipeline_cache.prefix_keys(img_bytes, img_type, plan.spec)
+            resumed, entry = self.pipeline_cache.lookup(cache_keys)
+            if entry is not None:
+                np_image, state = entry
+                ctx = ProcessingContext(**state)
+                pixels = np_image.shape[0] * np_image.shape[1]
+                duration["pipeline_cache_reused"] = [stage.name for stage in plan.stages[:resumed]]
+
+        # Only the stages left to run are budgeted, the cached prefix is kept at full quality
+        if deadline is not None and plan.stages[resumed:] and pixels is not None:
+            fitted = self._fitDeadline(plan, resumed, pixels, deadline, duration)
+            if fitted is not plan and cache_keys is not None:
+                cache_keys = self.pipeline_cache.prefix_keys(img_bytes, img_type, fitted.spec)
+            plan = fitted
+
+        if np_image is None:
+            np_image = decode_img(img_bytes, img_type)
+
+        if np_image is None:
+            errors["decode"] = f"Unable to decode image of type {img_type}"
+            return None, duration, errors
+
+        ctx.frame = Frame(np_image)
+
+        for index, stage in enumerate(plan.stages[resumed:], resumed):
+            if cancelled is not None and cancelled():
+                errors["cancelled"] = f"Cancelled before {stage.name}"
+                return None, duration, errors
+
+            stage_image = ctx.frame.view(stage.accepts)
 
             try: 
-                result = enhancement_func(self, np_image)
+                result, info = stage.run(self, stage_image, ctx)
             except Exception as e:
-                errors.update({enhancement_func.__name__: str(e)})
+                errors.update({stage.name: str(e)})
                 continue
 
-            if isinstance(result, list):
-                np_image = result[0]
-                duration.update(result[1])
-            elif result is None:
-                continue
-            else: 
-                np_image = result
+            if info:
+                duration.update(info)
+            if result is not None:
+                ctx.frame.update(result)
+
+            if info and stage.name in info:
+                self.cost_model.observe(
+                    stage.name,
+                    plan.spec[index][1],
+                    stage_image.shape[0] * stage_image.shape[1],
+                    ctx.frame.image.shape[0] * ctx.frame.image.shape[1],
+                    info[stage.name],
+                )
 
-        img_encoded = encode_img(np_image, img_type)
+            # Later intermediates depend on a failed stage, so stop caching after an error.
+            # Stages returning None leave the image unchanged and are cheap to redo.
+            if cache_keys is not None and not errors and result is not None:
+                self.pipeline_cache.put(cache_keys[index], ctx.frame.image, ctx.state())
+
+        if cancelled is not None and cancelled():
+            errors["cancelled"] = "Cancelled before encoding"
+            return None, duration, errors
+
+        encoding = dict(plan.encoding)
+        encoded_format = output_format(encoding, img_type)
+
+        encode_start = time.time()
+        img_encoded = encode_img(ctx.frame.view(np.uint8), encoded_format, encoding)
+        encode_time = time.time() - encode_start
+
+        pixels = ctx.frame.image.shape[0] * ctx.frame.image.shape[1]
+        self.cost_model.observe("encode", plan.encoding, pixels, pixels, encode_time)
+
+        if img_encoded is None:
+            errors["encode"] = f"Unable to encode image as {encoded_format}"
+            return None, duration, errors
+
+        duration["encode"] = encode_time
+        duration["encoded_bytes"] = img_encoded.nbytes
+        duration["output_format"] = encoded_format
 
         return img_encoded, duration, errors
 
+    def _fitDeadline(self, plan, resumed, pixels, deadline, duration):
+        """
+        Degrade the stages of a plan from `resumed` on, so their estimated run time
+        fits before the deadline. `pixels` is the size of the image they start from.
+        """
+
+        budget = deadline - time.time()
+        spec, degraded, estimate = self.planner.fit(
+            plan.spec[resumed:], stage_degradations(), pixels, budget, plan.encoding
+        )
+
+        duration["deadline_budget"] = budget
+        duration["deadline_estimate"] = estimate
+
+        if not degraded:
+            return plan
+
+        duration["degraded"] = degraded
+
+        return plan_from_spec(plan.spec[:resumed] + spec, plan.encoding)
+
 
     # IMAGE ENHANCEMENT FUNCTIONS
 
@@ -171,12 +1138,12 @@ class ImageEnhancer:
         """This function calculates the variance of the Laplacian of the input image. It is used as a measure of image sharpness.\n
         A low variance indicates that the image is blurry. This function does not enhance the image but allows for other functions to use the sharpness value.""",
     )
-    def laplacian_variance(self, image):
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    def laplacian_variance(self, image, ctx: ProcessingContext):
+        gray_image = ctx.frame.gray()
         laplacian = cv2.Laplacian(gray_image, cv2.CV_64F)
         laplacian_variance = laplacian.var()
 
-        self.sharpness = laplacian_variance
+        ctx.sharpness = laplacian_variance
 
         return None
 
@@ -186,90 +1153,182 @@ class ImageEnhancer:
         "Applies white balance correction to enhance the color balance in the image.",
     )
     @time_enhancement
-    def white_balance(self, image):
+    def white_balance(self, image, ctx: ProcessingContext):
         """
-        Apply white balance correction to an image
+        Apply white balance correction to an image.
+
+        The a/b shift for a pixel only depends on its L value and the channel means,
+        so it is applied as a 256 entry lookup table indexed by L. The channel means
+        are taken from a histogram of every `WB_SUBSAMPLE`th row and column.
         """
-        result = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
-        avg_a = np.average(result[:, :, 1])
-        avg_b = np.average(result[:, :, 2])
-        result[:, :, 1] = result[:, :, 1] - (
-            (avg_a - 128) * (result[:, :, 0] / 255.0) * 0.8
-        )
-        result[:, :, 2] = result[:, :, 2] - (
-            (avg_b - 128) * (result[:, :, 0] / 255.0) * 0.8
-        )
+        lab_img = ctx.frame.lab()
+        sample = lab_img[::WB_SUBSAMPLE, ::WB_SUBSAMPLE]
+        plane_shape = lab_img.shape[:2]
+
+        with buffer_pool.borrow(lab_img.shape, np.uint8) as balanced_lab_img, \
+                buffer_pool.borrow(plane_shape, np.uint8) as lightness, \
+                buffer_pool.borrow(plane_shape, np.uint8) as channel, \
+                buffer_pool.borrow(plane_shape, np.uint8) as shift:
+            np.copyto(balanced_lab_img, lab_img)
+            cv2.extractChannel(lab_img, 0, dst=lightness)
+
+            for i in (1, 2):
+                hist = cv2.calcHist([sample], [i], None, [256], [0, 256]).ravel()
+                channel_avg = np.dot(hist, np.arange(256)) / hist.sum()
+
+                shift_lut, subtract = white_balance_lut(channel_avg)
+                cv2.extractChannel(lab_img, i, dst=channel)
+                cv2.LUT(lightness, shift_lut, dst=shift)
 
-        white_balanced_img = cv2.cvtColor(result, cv2.COLOR_LAB2BGR)
+                if subtract:
+                    cv2.subtract(channel, shift, dst=channel)
+                else:
+                    cv2.add(channel, shift, dst=channel)
+
+                cv2.insertChannel(channel, balanced_lab_img, i)
+
+            white_balanced_img = cv2.cvtColor(balanced_lab_img, cv2.COLOR_LAB2BGR)
 
         return white_balanced_img
 
 
+    @enhancement_setting(
+        "super_res_model",
+        "Super-Resolution Model",
+        "The super-resolution model and scale factor. ESPCN is the fastest, FSRCNN x4 upscales the most.",
+        list(AVAILABLE_MODELS),
+        DEFAULT_MODEL,
+    )
+    @enhancement_degradation((None, 0))
     @enhancement_metadata(
         "Super-Resolution Upscaling",
         "Enhances image resolution using super-resolution techniques. Is computationally expensive.",
     )
     @time_enhancement
-    def super_res_upscale(self, image):
+    def super_res_upscale(self, image, ctx: ProcessingContext, super_res_model=DEFAULT_MODEL):
         """
         Super-Resolution Upscaling
         """
 
-        super_res_img = super_res_model.upsample(image)
+        if not self.super_res_batcher.enabled:
+            return self.super_res_models.upsample(image, super_res_model)
 
-        return super_res_img
+        super_res_img, batch_size = self.super_res_batcher.upsample(image, super_res_model)
 
+        return super_res_img, {"super_res_batch": batch_size}
 
+
+    @enhancement_setting(
+        "richard_lucy_mode",
+        "Deconvolution Iterations",
+        "Fixed runs the iteration count picked from the image sharpness. Adaptive stops early once the estimate stops changing.",
+        ["fixed", "adaptive"],
+        "fixed",
+    )
+    @enhancement_degradation(({"iteration_scale": 0.5}, 0.5), ({"iteration_scale": 0.25}, 0.25))
     @enhancement_metadata(
         "Richardson-Lucy Deconvolution",
         "Applies deconvolution to reduce blurring caused by camera optics.",
     )
+    @enhancement_dtype(np.float32)
     @time_enhancement
-    def richard_lucy_deconvolution(self, image):
+    def richard_lucy_deconvolution(self, image, ctx: ProcessingContext, richard_lucy_mode="fixed", iteration_scale=1.0):
         """
-        Richardson-Lucy Deconvolution
+        Richardson-Lucy Deconvolution. In adaptive mode the sharpness based iteration
+        count is used as a hard cap. `iteration_scale` reduces the iteration count
+        when the deadline planner degrades the stage.
         """
-        float_img = img_as_float(image)
+        height, width, point_spread_func  = self.get_img_config(image)
 
-        height, width, point_spread_func  = self.get_img_config(float_img)
-        pad_float_img = np.pad(float_img, ((height, height), (width, width), (0, 0)), mode='reflect')
+        iterations = self.get_iterations_by_sharpness(height*width, ctx.sharpness)
+        iterations = max(1, round(iterations * iteration_scale))
 
-        iterations = self.get_iterations_by_sharpness(height*width)
-        
-        deconvolved_img = np.zeros_like(pad_float_img)
+        # All channels are deconvolved together, see RichardsonLucyEngine.TOLERANCE for parity
+        threshold = RL_CONVERGENCE_THRESHOLD if richard_lucy_mode == "adaptive" else None
 
-        # Apply deconvolution channel by channel
-        for i in range(3):
-            deconvolved_img[:, :, i] = richardson_lucy(
-                pad_float_img[:, :, i], point_spread_func, num_iter=iterations
+        if should_tile(image):
+            return self._tiledDeconvolution(image, point_spread_func, iterations, threshold)
+
+        pad_shape = (image.shape[0] + 2 * height, image.shape[1] + 2 * width) + image.shape[2:]
+
+        with buffer_pool.borrow(pad_shape) as pad_float_img, buffer_pool.borrow(pad_shape) as deconvolved_img:
+            cv2.copyMakeBorder(image, height, height, width, width, cv2.BORDER_REFLECT_101, dst=pad_float_img)
+
+            _, iterations_used = self.rl_engine.deconvolve(
+                pad_float_img, point_spread_func, num_iter=iterations, threshold=threshold, out=deconvolved_img
             )
 
-        unpad_deconvolved_img = deconvolved_img[height:-height, width:-width]
+            unpad_deconvolved_img = deconvolved_img[height:-height, width:-width].copy()
 
-        deconvolved_img = img_as_ubyte(unpad_deconvolved_img)
+        return unpad_deconvolved_img, {"richard_lucy_iterations": iterations_used}
 
-        return deconvolved_img
+    def _tiledDeconvolution(self, image, point_spread_func, iterations, threshold):
+        """
+        Richardson-Lucy deconvolution of a large image in overlapping tiles. In adaptive
+        mode the centre tile picks the iteration count used by every other tile, so
+        that neighbouring tiles do not differ in sharpness.
+        """
+
+        bounds = tile_bounds(*image.shape[:2])
+        centre = bounds[len(bounds) // 2]
+
+        if threshold:
+            centre_halo = rl_halo(point_spread_func, iterations)
+            with buffer_pool.borrow(tile_shape(image, centre, centre_halo)) as centre_tile:
+                centre_img, iterations = self.rl_engine.deconvolve(
+                    extract_tile(image, centre, centre_halo, out=centre_tile), point_spread_func, iterations, threshold=threshold
+                )
+            bounds.remove(centre)
+
+        halo = rl_halo(point_spread_func, iterations)
+        deconvolved_img = process_tiled(
+            image,
+            lambda tile, out: self.rl_engine.deconvolve(tile, point_spread_func, iterations, out=out)[0],
+            halo,
+            bounds=bounds,
+        )
+
+        if threshold:
+            y0, y1, x0, x1 = centre
+            deconvolved_img[y0:y1, x0:x1] = centre_img[centre_halo:centre_halo + y1 - y0, centre_halo:centre_halo + x1 - x0]
+
+        return deconvolved_img, {"richard_lucy_iterations": iterations}
 
 
+    @enhancement_setting(
+        "clahe_backend",
+        "Histogram Equalization Backend",
+        "skimage equalizes each channel in float. opencv uses OpenCV's native CLAHE on each uint8 channel, opencv_lab on the LAB lightness channel only. The OpenCV backends are considerably faster.",
+        ["skimage", "opencv", "opencv_lab"],
+        "skimage",
+    )
+    @enhancement_degradation(({"clahe_backend": "opencv"}, 0.06))
     @enhancement_metadata(
         "Adaptive Histogram Equalization",
         "Enhances contrast using adaptive histogram equalization to improve image details.",
     )
+    @enhancement_dtype(lambda clahe_backend="skimage": np.float32 if clahe_backend == "skimage" else np.uint8)
     @time_enhancement
-    def adaptive_histograph_equalisation(self, image):
+    def adaptive_histograph_equalisation(self, image, ctx: ProcessingContext, clahe_backend="skimage"):
         """
         Adaptive Histogram Equalisation
         """
-        float_img = img_as_float(image)
+        # The clip limit affects the sharpness & contrast of the image. Lower values are better for noise reduction.
+        if clahe_backend == "opencv":
+            clahe = create_clahe(CLAHE_CLIP_LIMIT)
+            return cv2.merge([clahe.apply(channel) for channel in cv2.split(image)])
+
+        if clahe_backend == "opencv_lab":
+            clahe = create_clahe(CLAHE_CLIP_LIMIT)
+            lightness, *colour_channels = cv2.split(ctx.frame.lab())
+            lab_img = cv2.merge([clahe.apply(lightness), *colour_channels])
+            return cv2.cvtColor(lab_img, cv2.COLOR_LAB2BGR)
 
-        equalised_img = np.zeros_like(float_img)
+        equalised_img = np.empty_like(image)
         for i in range(3):
             equalised_img[:, :, i] = exposure.equalize_adapthist(
-                float_img[:, :, i], clip_limit=0.01
+                image[:, :, i], clip_limit=CLAHE_CLIP_LIMIT
             )
-        # The clip limit affects the sharpness & contrast of the image. Lower values are better for noise reduction.
-
-        equalised_img = img_as_ubyte(equalised_img)
 
         return equalised_img
 
@@ -289,13 +1348,13 @@ class ImageEnhancer:
         return pad_height * 3, pad_width * 3, point_spread_func
     
     
-    def get_iterations_by_sharpness(self, pixel_count): 
+    def get_iterations_by_sharpness(self, pixel_count, sharpness=None): 
         iter = 30
 
-        if not self.sharpness: 
+        if not sharpness: 
             return iter
         
-        if self.sharpness < 50:
+        if sharpness < 50:
             iter *= 1.2
             
         if pixel_count < 1000000:
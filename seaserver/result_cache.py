@@ -0,0 +1,230 @@
+"""
+COPYRIGHT: University of Sunshine Coast 2024
+
+AUTHOR: Joseph Thurlow <joseph.thurlow@protonmail.com>
+"""
+
+import hashlib
+import json
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from seaserver.processing import compile_plan
+
+# Spilled entries are the JSON encoded duration, prefixed by its length, followed
+# by the encoded image. Nothing read back from disk is ever unpickled.
+SPILL_HEADER = struct.Struct(">I")
+
+
+def result_key(image_bytes, image_type: str, config) -> str:
+    """
+    Content address of a job: a hash of the uploaded bytes, the image type (which
+    decides the output encoding) and the key of the compiled plan.
+
+    Args:
+        image_bytes: The upload, any object supporting the buffer protocol.
+        image_type (str): The upload's MIME type.
+        config (dict | EnhancementPlan): The configuration or its compiled plan.
+    """
+
+    digest = hashlib.sha256(image_bytes)
+    digest.update(image_type.encode())
+    digest.update(compile_plan(config).key.encode())
+
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Byte budgeted LRU cache of encoded results, keyed by `result_key`.
+
+    Entries evicted from memory are written to `spill_dir` when one is given and
+    moved back into memory when they are hit again. The spill directory has its own
+    budget and is indexed on startup, so spilled results survive a restart. Spilled
+    files hold a length prefixed JSON header and the raw image, never pickles.
+
+    Args:
+        max_bytes (int): Memory budget for the encoded results.
+        spill_dir (str): Directory evicted entries are spilled to, or None.
+        max_disk_bytes (int): Budget for the spill directory.
+    """
+
+    def __init__(self, max_bytes: int, spill_dir: str = None, max_disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self.size = 0
+        self.disk_size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._disk = OrderedDict()
+        self._lock = threading.Lock()
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._indexSpillDir()
+
+    def get(self, key: str):
+        """
+        Look up a result.
+
+        Returns:
+            tuple: The cached `(img_encoded, duration)`, or None on a miss.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+            on_disk = key in self._disk
+
+        entry = self._readSpilled(key) if on_disk else None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+        self.put(key, *entry)
+
+        return entry
+
+    def put(self, key: str, img_encoded: bytes, duration: dict):
+        """
+        Store an encoded result. Results larger than the whole budget are not kept.
+        """
+
+        if len(img_encoded) > self.max_bytes:
+            return
+
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key)[0])
+
+            self._entries[key] = (img_encoded, duration)
+            self.size += len(img_encoded)
+
+            while self.size > self.max_bytes:
+                evicted_key, evicted_entry = self._entries.popitem(last=False)
+                self.size -= len(evicted_entry[0])
+                evicted.append((evicted_key, evicted_entry))
+
+        if self.spill_dir:
+            for evicted_key, evicted_entry in evicted:
+                self._spill(evicted_key, evicted_entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self.disk_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, f"{key}.result")
+
+    def _indexSpillDir(self):
+        files = []
+        for filename in os.listdir(self.spill_dir):
+            if filename.endswith(".result"):
+                stat = os.stat(os.path.join(self.spill_dir, filename))
+                files.append((stat.st_mtime, filename[:-len(".result")], stat.st_size))
+
+        for _, key, size in sorted(files):
+            self._disk[key] = size
+            self.disk_size += size
+
+        self._trimDisk()
+
+    def _spill(self, key: str, entry: tuple):
+        img_encoded, duration = entry
+        header = json.dumps(duration).encode()
+        data = SPILL_HEADER.pack(len(header)) + header + img_encoded
+        if len(data) > self.max_disk_bytes:
+            return
+
+        try:
+            with open(self._path(key), "wb") as f:
+                f.write(data)
+        except OSError as e:
+            print(f"Unable to spill cached result: {e}")
+            return
+
+        with self._lock:
+            self.disk_size -= self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            self.disk_size += len(data)
+            self._trimDisk()
+
+    def _readSpilled(self, key: str):
+        with self._lock:
+            size = self._disk.pop(key, None)
+            if size is None:
+                return None
+            self.disk_size -= size
+
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.remove(self._path(key))
+
+            (header_size,) = SPILL_HEADER.unpack_from(data)
+            header_end = SPILL_HEADER.size + header_size
+            if header_end > len(data):
+                raise ValueError("truncated header")
+
+            duration = json.loads(data[SPILL_HEADER.size:header_end])
+            if not isinstance(duration, dict):
+                raise ValueError("malformed header")
+
+            entry = (data[header_end:], duration)
+        except (OSError, struct.error, ValueError) as e:
+            print(f"Unable to read spilled result: {e}")
+            entry = None
+
+        return entry
+
+    def _trimDisk(self):
+        # Called with the lock held
+        while self.disk_size > self.max_disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self.disk_size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+def create_result_cache() -> ResultCache:
+    """
+    Create the result cache configured by `RESULT_CACHE_MB` (default 256, 0 disables
+    the cache), `RESULT_CACHE_DIR` (spill directory, unset disables spilling) and
+    `RESULT_CACHE_DISK_MB` (default 1024).
+
+    Returns:
+        ResultCache: The cache, or None when disabled.
+    """
+
+    max_bytes = int(float(os.environ.get("RESULT_CACHE_MB", 256)) * 1024 * 1024)
+    if max_bytes <= 0:
+        return None
+
+    spill_dir = os.environ.get("RESULT_CACHE_DIR") or None
+    max_disk_bytes = int(float(os.environ.get("RESULT_CACHE_DISK_MB", 1024)) * 1024 * 1024)
+
+    return ResultCache(max_bytes, spill_dir, max_disk_bytes)
@@ -0,0 +1,164 @@
+"""
+COPYRIGHT: University of Sunshine Coast 2024
+
+AUTHOR: Joseph Thurlow <joseph.thurlow@protonmail.com>
+"""
+
+import threading
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+import numpy as np
+
+
+class SlotDescriptor(NamedTuple):
+    """
+    Small, picklable reference to a region of a `SharedRingBuffer`. This is the only
+    thing that crosses the process pool queue for shared memory jobs.
+    """
+
+    name: str
+    index: int
+    offset: int
+    length: int
+
+
+class SharedRingBuffer:
+    """
+    A fixed number of equally sized slots carved out of one shared memory segment.
+
+    The web process owns the ring: it hands out slots round-robin, writes uploads
+    straight into them and releases them once the result has been sent. Workers
+    attach to the segment by name, decode the upload in place and write the encoded
+    result back into the same slot.
+
+    Args:
+        slot_count (int): Number of slots (i.e. maximum number of jobs in flight).
+        slot_size (int): Size of each slot in bytes.
+    """
+
+    def __init__(self, slot_count: int, slot_size: int):
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=slot_count * slot_size)
+        self.name = self.shm.name
+
+        self._free = [True] * slot_count
+        self._cursor = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> int:
+        """
+        Claim the next free slot after the cursor.
+
+        Returns:
+            int: The slot index, or None if every slot is in use.
+        """
+
+        with self._lock:
+            for step in range(self.slot_count):
+                index = (self._cursor + step) % self.slot_count
+                if self._free[index]:
+                    self._free[index] = False
+                    self._cursor = (index + 1) % self.slot_count
+                    return index
+
+        return None
+
+    def release(self, index: int):
+        with self._lock:
+            self._free[index] = True
+
+    def slot(self, index: int) -> memoryview:
+        offset = index * self.slot_size
+        return self.shm.buf[offset:offset + self.slot_size]
+
+    def descriptor(self, index: int, length: int) -> SlotDescriptor:
+        return SlotDescriptor(self.name, index, index * self.slot_size, length)
+
+    def view(self, descriptor: SlotDescriptor) -> memoryview:
+        return self.shm.buf[descriptor.offset:descriptor.offset + descriptor.length]
+
+    def readinto(self, stream):
+        """
+        Read an upload stream directly into a free slot.
+
+        Args:
+            stream: A binary file-like object supporting `readinto`.
+
+        Returns:
+            SlotDescriptor | bytes: A descriptor for the written slot, or the upload as
+            bytes when no slot is free or the upload does not fit in a slot.
+        """
+
+        index = self.acquire()
+        if index is None:
+            return stream.read()
+
+        slot = self.slot(index)
+        try:
+            length = 0
+            while length < self.slot_size:
+                read = stream.readinto(slot[length:])
+                if not read:
+                    break
+                length += read
+
+            overflow = stream.read() if length == self.slot_size else b""
+            if overflow:
+                data = bytes(slot[:length]) + overflow
+                self.release(index)
+                return data
+        finally:
+            slot.release()
+
+        return self.descriptor(index, length)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Worker side: segments attached by name, kept open for the life of the worker
+_attached: dict[str, shared_memory.SharedMemory] = {}
+
+
+def attach(descriptor: SlotDescriptor) -> shared_memory.SharedMemory:
+    shm = _attached.get(descriptor.name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=descriptor.name)
+        _attached[descriptor.name] = shm
+
+    return shm
+
+
+def slot_array(descriptor: SlotDescriptor, length: int = None) -> np.ndarray:
+    """
+    A uint8 array viewing a slot in place, no data is copied.
+
+    Args:
+        descriptor (SlotDescriptor): The slot to view.
+        length (int): Number of bytes to view, defaults to the descriptor length.
+    """
+
+    shm = attach(descriptor)
+    length = descriptor.length if length is None else length
+
+    return np.ndarray((length,), dtype=np.uint8, buffer=shm.buf, offset=descriptor.offset)
+
+
+def write_result(descriptor: SlotDescriptor, img_encoded: np.ndarray, slot_size: int):
+    """
+    Write an encoded result back into the slot the upload came from.
+
+    Returns:
+        SlotDescriptor | ndarray: A descriptor for the result, or the encoded array
+        itself when it does not fit in the slot.
+    """
+
+    if img_encoded is None or img_encoded.nbytes > slot_size:
+        return img_encoded
+
+    slot_array(descriptor, img_encoded.nbytes)[:] = img_encoded.reshape(-1)
+
+    return descriptor._replace(length=img_encoded.nbytes)
@@ -0,0 +1,454 @@
+"""
+COPYRIGHT: University of Sunshine Coast 2024
+
+AUTHOR: Joseph Thurlow <joseph.thurlow@protonmail.com>
+"""
+
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+from seaserver import models, processing
+from seaserver.admission import JobTicket, create_admission_controller
+from seaserver.processing import ImageEnhancer, compile_plan
+from seaserver.result_cache import create_result_cache, result_key
+from seaserver.shared_buffers import SharedRingBuffer, SlotDescriptor, slot_array, write_result
+
+BACKEND_THREAD = "thread"
+BACKEND_PROCESS = "process"
+
+# Cancellation flags shared with process workers, reused round robin by job
+CANCEL_SLOTS = 4096
+
+
+class ExecutionBackend:
+    """
+    Base class for the executors that run `ImageEnhancer.processImg` jobs.
+
+    A backend accepts the upload read by `read_upload` and the session configuration
+    and returns a future. The `(img_encoded, duration, errors)` tuple produced by
+    `processImg` is then read with `result`, which also frees any resources held by
+    the job.
+
+    Results are kept in a `ResultCache` keyed by the upload and its normalised
+    configuration. A repeated job is answered from the cache without being run, and
+    its `duration` reports the hit instead of stage timings.
+
+    A progressive job also runs a preview on a downscaled proxy ahead of the full
+    job, available as the `preview` future of the returned future.
+
+    Jobs are admitted by an `AdmissionController` (`admission`) before their
+    upload is read, which bounds the jobs and upload bytes the backend holds.
+    """
+
+    name: str = None
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.cache = create_result_cache()
+        self.admission = create_admission_controller(self.max_workers)
+
+    def read_upload(self, stream):
+        """
+        Read an uploaded image stream into whatever form the backend submits.
+        """
+
+        return stream.read()
+
+    def upload_buffer(self, image_bytes):
+        """
+        The raw bytes of an upload returned by `read_upload`, for hashing.
+        """
+
+        return image_bytes
+
+    def submit(
+        self,
+        image_bytes,
+        image_type: str,
+        config,
+        deadline: float = None,
+        progressive: bool = False,
+        ticket: JobTicket = None,
+    ) -> Future:
+        """
+        Submit a job, answering it from the result cache when possible.
+
+        Args:
+            image_bytes: The upload returned by `read_upload`.
+            image_type (str): The upload's MIME type.
+            config (dict | EnhancementPlan): The configuration or its compiled plan.
+            deadline (float): Optional `time.time()` the result is due by, see
+                `ImageEnhancer.processImg`.
+            progressive (bool): Also submit a preview, unless the result is cached.
+            ticket (JobTicket): The job's admission, released once the job completes.
+
+        Returns:
+            Future: The full job, with the preview job (or None) as `future.preview`.
+        """
+
+        plan = compile_plan(config)
+
+        key = None
+        if self.cache is not None:
+            start_time = time.time()
+            key = result_key(self.upload_buffer(image_bytes), image_type, plan)
+            cached = self.cache.get(key)
+
+            if cached is not None:
+                img_encoded, cached_duration = cached
+                duration = {"result_cache": "hit", "result_cache_lookup": time.time() - start_time}
+                for name in ("encoded_bytes", "output_format"):
+                    if name in cached_duration:
+                        duration[name] = cached_duration[name]
+
+                future = Future()
+                future.set_result((img_encoded, duration, {}))
+                future.cache_key = None
+                future.preview = None
+                return self._releaseOnDone(future, ticket)
+
+        # The preview is queued first so it isn't stuck behind the full job
+        preview = None
+        if progressive:
+            preview = self._submitJob(image_bytes, image_type, plan, None, preview=True)
+            preview.cache_key = None
+            preview.preview = None
+
+        future = self._submitJob(image_bytes, image_type, plan, deadline)
+        future.cache_key = key
+        future.preview = preview
+
+        return self._releaseOnDone(future, ticket)
+
+    def _releaseOnDone(self, future: Future, ticket: JobTicket) -> Future:
+        if ticket is not None:
+            future.add_done_callback(lambda _: self.admission.release(ticket))
+
+        return future
+
+    def _submitJob(self, image_bytes, image_type: str, plan, deadline: float, preview: bool = False) -> Future:
+        raise NotImplementedError
+
+    def cancel(self, future: Future):
+        """
+        Cancel a job returned by `submit` and its preview. Queued jobs are dropped,
+        running jobs are abandoned at their next stage boundary.
+        """
+
+        for job in (future.preview, future):
+            if job is not None and not job.done() and not job.cancel():
+                self._cancelRunning(job)
+
+    def _cancelRunning(self, future: Future):
+        raise NotImplementedError
+
+    def _cacheResult(self, future: Future, img_encoded, duration: dict, errors: dict):
+        # Only complete, error free and undegraded results are worth repeating
+        if future.cache_key is None or img_encoded is None or errors or "degraded" in duration:
+            return
+
+        self.cache.put(future.cache_key, bytes(img_encoded), dict(duration))
+        duration["result_cache"] = "miss"
+
+    def _observeResult(self, future: Future, img_encoded, duration: dict, errors: dict):
+        if "queue_wait" in duration:
+            self.admission.observe_wait(duration["queue_wait"])
+
+        self._cacheResult(future, img_encoded, duration, errors)
+
+    @contextmanager
+    def result(self, future: Future):
+        """
+        Context manager yielding the `(img_encoded, duration, errors)` result of a job.
+        `img_encoded` is only valid inside the context.
+        """
+
+        img_encoded, duration, errors = future.result()
+        self._observeResult(future, img_encoded, duration, errors)
+
+        yield img_encoded, duration, errors
+
+    def metrics(self) -> dict:
+        """
+        Backend metrics for the `/metrics` endpoint.
+        """
+
+        return {
+            "backend": self.name,
+            "workers": self.max_workers,
+            "result_cache": self.cache.stats() if self.cache is not None else None,
+            "job_queue": self.admission.stats(),
+        }
+
+    def shutdown(self, wait: bool = True):
+        raise NotImplementedError
+
+
+class ThreadBackend(ExecutionBackend):
+    """
+    Runs jobs on a thread pool sharing a single `ImageEnhancer`, each thread holding
+    its own super-resolution models. Cheap to start and
+    suited to I/O bound or lightly loaded deployments, but the GIL bound stages will
+    not scale past roughly one core.
+    """
+
+    name = BACKEND_THREAD
+
+    def __init__(self, max_workers: int = None):
+        super().__init__(max_workers)
+        self.enhancer = ImageEnhancer()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._warmUp()
+
+    def _warmUp(self):
+        """
+        Start every worker thread and preload its super-resolution models. The barrier
+        keeps each thread busy until all have started, so every thread gets a task.
+        """
+
+        # Batched super-resolution runs on the batcher's own thread instead
+        if self.enhancer.super_res_batcher.enabled:
+            self.enhancer.super_res_batcher.preload()
+            return
+
+        barrier = threading.Barrier(self.max_workers)
+
+        def warm_up():
+            try:
+                self.enhancer.super_res_models.preload()
+            except Exception as e:
+                print(f"Unable to preload super-resolution models: {e}")
+            finally:
+                # A thread that fails to preload must still release the others
+                barrier.wait()
+
+        for _ in range(self.max_workers):
+            self.executor.submit(warm_up)
+
+    def _submitJob(self, image_bytes, image_type, plan, deadline, preview=False):
+        cancel_event = threading.Event()
+        future = self.executor.submit(
+            self._runJob, time.time(), cancel_event.is_set, image_bytes, image_type, plan, deadline, preview
+        )
+        future.cancel_event = cancel_event
+
+        return future
+
+    def _cancelRunning(self, future):
+        future.cancel_event.set()
+
+    def _runJob(self, submitted, cancelled, *args):
+        queue_wait = time.time() - submitted
+        img_encoded, duration, errors = self.enhancer.processImg(*args, cancelled=cancelled)
+        duration["queue_wait"] = queue_wait
+
+        return img_encoded, duration, errors
+
+    def metrics(self):
+        metrics = super().metrics()
+        metrics["buffer_pool"] = processing.buffer_pool.stats()
+        metrics["stage_costs"] = self.enhancer.cost_model.stats()
+
+        return metrics
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+# Per-process state for the process backend. Each worker builds its own enhancer
+# (and therefore its own super-resolution model) in `_init_worker`.
+_worker_enhancer: ImageEnhancer = None
+_cancel_flags = None
+
+
+def _init_worker(cancel_flags):
+    global _worker_enhancer, _cancel_flags
+
+    _cancel_flags = cancel_flags
+
+    # The pool already uses every core, so tiles run inline unless told otherwise
+    if "TILE_WORKERS" not in os.environ:
+        processing.TILE_WORKERS = 1
+
+    # A worker runs one job at a time, so there is nothing to batch with
+    if "SUPER_RES_BATCH_SIZE" not in os.environ:
+        models.SUPER_RES_BATCH_SIZE = 1
+
+    _worker_enhancer = ImageEnhancer()
+    _worker_enhancer.super_res_models.preload()
+
+
+def _is_cancelled(cancel_slot):
+    return _cancel_flags[cancel_slot] == 1
+
+
+def _process_in_worker(payload, image_type, plan, slot_size, deadline, preview, submitted, cancel_slot):
+    queue_wait = time.time() - submitted
+    cancelled = partial(_is_cancelled, cancel_slot)
+
+    if not isinstance(payload, SlotDescriptor):
+        img_encoded, duration, errors = _worker_enhancer.processImg(
+            payload, image_type, plan, deadline, preview, cancelled
+        )
+    else:
+        # Decode straight from shared memory and write the encoded result back in place
+        img_encoded, duration, errors = _worker_enhancer.processImg(
+            slot_array(payload), image_type, plan, deadline, preview, cancelled
+        )
+        img_encoded = write_result(payload, img_encoded, slot_size)
+
+    duration["queue_wait"] = queue_wait
+
+    # The worker's buffer pool metrics travel back with every result
+    worker_metrics = (os.getpid(), processing.buffer_pool.stats())
+
+    return img_encoded, duration, errors, worker_metrics
+
+
+class ProcessBackend(ExecutionBackend):
+    """
+    Runs jobs on a pool of worker processes, each holding its own `ImageEnhancer`
+    and super-resolution model. Workers are spawned rather than forked so that no
+    OpenCV or DNN state is inherited from the web process.
+
+    Uploads and results are handed over through a `SharedRingBuffer` so that only
+    slot descriptors are pickled. The ring is sized with `SHARED_RING_SLOTS` and
+    `SHARED_RING_SLOT_MB`; uploads that do not fit fall back to being pickled.
+    """
+
+    name = BACKEND_PROCESS
+
+    def __init__(self, max_workers: int = None):
+        super().__init__(max_workers)
+
+        # Running jobs are cancelled through flags in shared memory
+        mp_context = multiprocessing.get_context("spawn")
+        self.cancel_flags = mp_context.RawArray("b", CANCEL_SLOTS)
+        self._cancel_slots = itertools.count()
+
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(self.cancel_flags,),
+        )
+
+        slot_count = int(os.environ.get("SHARED_RING_SLOTS", self.max_workers * 2))
+        slot_size = int(float(os.environ.get("SHARED_RING_SLOT_MB", 16)) * 1024 * 1024)
+        self.ring = SharedRingBuffer(slot_count, slot_size)
+
+        # Latest buffer pool metrics reported by each worker process, by PID
+        self.worker_metrics = {}
+
+    def read_upload(self, stream):
+        return self.ring.readinto(stream)
+
+    def upload_buffer(self, image_bytes):
+        if isinstance(image_bytes, SlotDescriptor):
+            return self.ring.view(image_bytes)
+
+        return image_bytes
+
+    def submit(self, image_bytes, image_type, config, deadline=None, progressive=False, ticket=None):
+        future = super().submit(image_bytes, image_type, config, deadline, progressive, ticket)
+        future.slot = image_bytes.index if isinstance(image_bytes, SlotDescriptor) else None
+        if future.preview is not None:
+            future.preview.slot = None
+
+        return future
+
+    def _submitJob(self, image_bytes, image_type, plan, deadline, preview=False):
+        # The full job writes its result over the upload's slot, so a preview
+        # of the same upload is sent a copy
+        if preview and isinstance(image_bytes, SlotDescriptor):
+            image_bytes = bytes(self.ring.view(image_bytes))
+
+        cancel_slot = next(self._cancel_slots) % CANCEL_SLOTS
+        self.cancel_flags[cancel_slot] = 0
+
+        future = self.executor.submit(
+            _process_in_worker,
+            image_bytes,
+            image_type,
+            plan,
+            self.ring.slot_size,
+            deadline,
+            preview,
+            time.time(),
+            cancel_slot,
+        )
+        future.cancel_slot = cancel_slot
+
+        return future
+
+    def _cancelRunning(self, future):
+        self.cancel_flags[future.cancel_slot] = 1
+
+    @contextmanager
+    def result(self, future):
+        view = None
+        try:
+            # Results answered from the cache carry no worker metrics
+            img_encoded, duration, errors, *worker_metrics = future.result()
+            for pid, pool_stats in worker_metrics:
+                self.worker_metrics[pid] = pool_stats
+
+            if isinstance(img_encoded, SlotDescriptor):
+                img_encoded = view = self.ring.view(img_encoded)
+
+            self._observeResult(future, img_encoded, duration, errors)
+
+            yield img_encoded, duration, errors
+        finally:
+            if view is not None:
+                view.release()
+            if future.slot is not None:
+                self.ring.release(future.slot)
+
+    def metrics(self):
+        metrics = super().metrics()
+        metrics["buffer_pool"] = dict(self.worker_metrics)
+
+        return metrics
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        self.ring.close()
+
+
+BACKENDS = {
+    BACKEND_THREAD: ThreadBackend,
+    BACKEND_PROCESS: ProcessBackend,
+}
+
+
+def create_backend(name: str = None, max_workers: int = None) -> ExecutionBackend:
+    """
+    Create the execution backend selected at startup.
+
+    Args:
+        name (str): `thread` or `process`. Defaults to the `EXECUTION_BACKEND`
+            environment variable, falling back to `thread`.
+        max_workers (int): Number of worker threads/processes. Defaults to the
+            `ENHANCE_WORKERS` environment variable, falling back to the CPU count.
+
+    Returns:
+        ExecutionBackend: The configured backend.
+    """
+
+    name = (name or os.environ.get("EXECUTION_BACKEND") or BACKEND_THREAD).lower()
+
+    if max_workers is None and os.environ.get("ENHANCE_WORKERS"):
+        max_workers = int(os.environ["ENHANCE_WORKERS"])
+
+    backend_cls = BACKENDS.get(name)
+    if backend_cls is None:
+        raise ValueError(f"Unknown execution backend '{name}', expected one of {list(BACKENDS)}")
+
+    return backend_cls(max_workers=max_workers)